@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+-------------------------------------------------------------------------------
+Benchmark.py, the performance harness for Similar.py.
+-------------------------------------------------------------------------------
+@brief measure Similar on labeled dirty names generated from its own
+error models.
+
+A dictionary of the chosen size is made from the canonical names in
+boards.csv, padded with synthetic names built from their words and from
+pronounceable made-up words.  Dirty variants of its names are generated,
+each labeled with its canonical name and the error model used:
+
+exact:       the canonical name unchanged.
+fat finger:  a letter replaced by a neighbor on the QWERTY or DVORAK keyboard.
+insert:      a letter inserted.
+delete:      a letter deleted.
+typo:        a letter replaced by any other.
+swap:        two adjacent letters exchanged.
+contraction: a word shortened, as "Int'l" for International or "Amer.".
+acronym:     the first letters of the words, as "MIT".
+
+For each dictionary size and each algorithms setting this measures
+the time to fill the dictionary, lexing throughput, call throughput,
+per-call latency percentiles, and how often the labeled canonical name
+(correct) or any name at all (matched) was found.
+The results are printed and may be saved as a JSON baseline,
+and compared with a previous baseline.
+
+Example:
+./Benchmark.py --sizes 1000,10000 --output baseline.json
+./Benchmark.py --sizes 1000,10000 --compare baseline.json
+"""
+
+
+import sys
+import json
+import random
+import string
+import timeit
+import optparse
+
+from Similar import Similar, read_boards
+
+
+# Syllables for made-up words padding a dictionary beyond boards.csv.
+ONSETS = ['B', 'C', 'D', 'F', 'G', 'H', 'K', 'L', 'M', 'N', 'P', 'R', 'S',
+          'T', 'V', 'W', 'BR', 'CH', 'CL', 'GR', 'PR', 'ST', 'TR', 'SH']
+VOWELS = ['A', 'E', 'I', 'O', 'U', 'AI', 'EA', 'OU']
+CODAS = ['', '', 'N', 'R', 'S', 'L', 'T', 'M', 'CK', 'ND', 'RT', 'ST']
+
+MODELS = ['exact', 'fat finger', 'insert', 'delete', 'typo', 'swap',
+          'contraction', 'acronym']
+
+
+def generate_word(rng):
+    # Make a pronounceable word of two to four syllables.
+    return string.join([rng.choice(ONSETS) + rng.choice(VOWELS) +
+        rng.choice(CODAS) for n in range(rng.randint(2, 4))], '').title()
+
+
+def generate_names(seeds, size, rng):
+    # Make size distinct canonical names, the seed names first.
+    # The rest combine words of the seed names with made-up words.
+    names, seen = [], set()
+    words = [word for name in seeds for word in name.split() if len(word) > 3]
+    words += [generate_word(rng) for n in range(max(100, size // 4))]
+    for name in seeds + [None] * size:
+        if len(names) >= size:
+            break
+        while name is None or name.upper() in seen:
+            name = string.join(
+                    rng.sample(words, rng.randint(2, 5)), ' ')
+        seen.add(name.upper())
+        names.append(name)
+    return names
+
+
+class Dirty(object):
+    # Generate dirty variants of canonical names with Similar's error models.
+
+    def __init__(self, rng, keyboards=('QWERTY', 'DVORAK')):
+        self.rng = rng
+        self.keyboards = [Similar.keyboard[name] for name in keyboards]
+
+    def letters(self, name):
+        # Positions of letters, where errors are made.
+        return [n for n, c in enumerate(name) if c.isalpha()]
+
+    def exact(self, name):
+        return name
+
+    def fat_finger(self, name):
+        n = self.rng.choice(self.letters(name))
+        keyboard = self.rng.choice(self.keyboards)
+        neighbors = [c for c in keyboard.get(name[n].upper(), '')
+                if c.isalpha() and c.upper() != name[n].upper()]
+        if not neighbors:
+            return name
+        return name[:n] + self.rng.choice(neighbors) + name[n+1:]
+
+    def insert(self, name):
+        n = self.rng.choice(self.letters(name))
+        return name[:n] + self.rng.choice(string.ascii_lowercase) + name[n:]
+
+    def delete(self, name):
+        n = self.rng.choice(self.letters(name))
+        return name[:n] + name[n+1:]
+
+    def typo(self, name):
+        n = self.rng.choice(self.letters(name))
+        return name[:n] + self.rng.choice(string.ascii_lowercase) + name[n+1:]
+
+    def swap(self, name):
+        pairs = [n for n in self.letters(name)[:-1]
+                if name[n+1].isalpha() and name[n] != name[n+1]]
+        if not pairs:
+            return name
+        n = self.rng.choice(pairs)
+        return name[:n] + name[n+1] + name[n] + name[n+2:]
+
+    def contraction(self, name):
+        words = name.split()
+        n = self.rng.choice([n for n, word in enumerate(words)
+            if len(word) > 4] or [0])
+        word = words[n]
+        if self.rng.random() < 0.5:
+            words[n] = word[:3] + "'" + word[-1]
+        else:
+            words[n] = word[:self.rng.randint(2, 4)] + '.'
+        return string.join(words, ' ')
+
+    def acronym(self, name):
+        return string.join([word[0].upper() for word in name.split()
+            if word.upper() not in Similar.stopwords], '')
+
+    def __call__(self, names, count):
+        # Generate count (dirty, canonical, model) triples.
+        for n in range(count):
+            name = self.rng.choice(names)
+            model = MODELS[n % len(MODELS)]
+            yield getattr(self, model.replace(' ', '_'))(name), name, model
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(names, samples, algorithms):
+    # Fill a dictionary with names and time Similar on the labeled samples.
+    timer = timeit.default_timer
+    similar = Similar(algorithms=algorithms)
+    start = timer()
+    for name in names:
+        similar.fill_arbor(name)
+    fill = timer() - start
+
+    start = timer()
+    for dirty, canonical, model in samples:
+        similar.lex_line(dirty)
+    lex = timer() - start
+
+    latencies, correct, matched = [], {}, {}
+    for dirty, canonical, model in samples:
+        start = timer()
+        matchBool, found, used = similar(dirty)
+        latencies.append(timer() - start)
+        hit = found == canonical or (
+                isinstance(found, set) and canonical in found)
+        correct[model] = correct.get(model, 0) + bool(hit)
+        matched[model] = matched.get(model, 0) + bool(matchBool and found)
+    total = sum(latencies)
+    latencies.sort()
+    count = len(samples)
+    per_model = count // len(MODELS)
+    return {
+            'fill_seconds'   : fill,
+            'lex_per_second' : count / lex if lex else 0.0,
+            'calls_per_second': count / total if total else 0.0,
+            'latency_p50_ms' : 1000 * percentile(latencies, 0.50),
+            'latency_p90_ms' : 1000 * percentile(latencies, 0.90),
+            'latency_p99_ms' : 1000 * percentile(latencies, 0.99),
+            'correct_rate'   : sum(correct.values()) / float(count),
+            'matched_rate'   : sum(matched.values()) / float(count),
+            'correct_by_model': dict((model, correct.get(model, 0) /
+                float(per_model)) for model in MODELS),
+            }
+
+
+def benchmark(seeds, sizes, count, settings, seed=0):
+    # Measure every algorithms setting at every dictionary size.
+    results = []
+    for size in sizes:
+        rng = random.Random(seed)
+        names = generate_names(seeds, size, rng)
+        samples = list(Dirty(rng)(names, count))
+        for algorithms in settings:
+            result = measure(names, samples, algorithms)
+            result.update({'size': size, 'algorithms': algorithms,
+                'samples': count})
+            results.append(result)
+    return results
+
+
+def report(results, baseline=None):
+    # Print results, with the ratio to a matching baseline entry if any.
+    previous = dict(((entry['size'], entry['algorithms']), entry)
+            for entry in baseline or [])
+    columns = ['calls_per_second', 'latency_p50_ms', 'latency_p99_ms',
+            'correct_rate', 'matched_rate']
+    print '%8s %-10s' % ('size', 'algorithms'), string.join(
+            ['%16s' % column for column in columns], ' ')
+    for entry in results:
+        old = previous.get((entry['size'], entry['algorithms']), {})
+        cells = []
+        for column in columns:
+            cell = '%.4g' % entry[column]
+            if old.get(column):
+                cell += ' (%.2fx)' % (entry[column] / old[column])
+            cells.append('%16s' % cell)
+        print '%8d %-10s' % (entry['size'], entry['algorithms']), string.join(
+                cells, ' ')
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]',
+            description='Measure Similar on generated dirty names.')
+    parser.add_option('-b', '--boards', default='boards.csv',
+        help='canonical names to start from [%default]')
+    parser.add_option('-s', '--sizes', default='1000,10000',
+        help='comma separated dictionary sizes [%default]')
+    parser.add_option('-n', '--samples', type='int', default=2000,
+        help='dirty names per measurement [%default]')
+    parser.add_option('-a', '--algorithms', default='e,eL,cefL,cefLmNs',
+        help='comma separated algorithms settings [%default]')
+    parser.add_option('-r', '--seed', type='int', default=0,
+        help='random seed [%default]')
+    parser.add_option('-o', '--output',
+        help='save the results as a JSON baseline')
+    parser.add_option('-c', '--compare',
+        help='compare with a saved JSON baseline')
+    options, args = parser.parse_args(argv)
+
+    seeds = [item[0] for item in read_boards(options.boards)]
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = benchmark(seeds, sizes, options.samples,
+            options.algorithms.split(','), options.seed)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as source:
+            baseline = json.load(source)
+    report(results, baseline)
+    if options.output:
+        with open(options.output, 'w') as target:
+            json.dump(results, target, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
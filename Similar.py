@@ -8,16 +8,16 @@ Author: Jonathan D. Lettvin
 Date: 20120112
 Date: 20120124 up to 71% coverage of boards.csv
 -------------------------------------------------------------------------------
-@brief acronym, fat finger, Levenshtein1, contraction implementations.
-soundex, metaphone, and NYSSIS are unimplemented as yet.
+@brief acronym, fat finger, Levenshtein1, contraction, soundex, metaphone,
+and NYSSIS implementations.
 
 acronym:     when American Board of Medical Examiners is intended for ABME.
 Levenshtein: when American is intended by Americian, Amercan, or Amercian.
 fat finger:  when a finger strikes a key adjacent to an intended key by accident.
 contraction: when "American Board" is for "Am Bd", or Internal for Int'l.
-soundex:     unimplemented.
-metaphone:   unimplemented.
-NYSSIS:      unimplemented.
+soundex:     when Massachusetts is intended by Masachusets (same Soundex).
+metaphone:   when Physician is intended by Fysician (same Double Metaphone).
+NYSSIS:      when Knight is intended by Night (same NYSIIS code).
 
 WARNING! This code makes log and csv files in it's local directory
 when run as a CLI from the command-line.
@@ -30,6 +30,9 @@ may be unaware that a finger has fallen on the wrong key, or hand displaced.
 The origins of the Levenshtein1 are in Levenshtein distances of 1.
 This function implements an efficient distance of 1 or less evaluation.
 This includes 1 character insertion, deletion, typo, or two character swap.
+Its generalization 'K' allows 2 or 3 such edits in long tokens, finding
+every vocabulary token in reach of a rough one in a single walk of
+a character trie.
 
 The origins of the contraction is more ancient, but with interesting modern
 application, since Levenshtein character swapping deletion and insertion
@@ -50,7 +53,1010 @@ Here is a representative line from boards.csv:
 
 
 import string
+import unicodedata
 import fuzzy
+import re
+import os
+import sys
+import bz2
+import gzip
+import mmap
+import array
+import bisect
+import struct
+import itertools
+import heapq
+import json
+import time
+import signal
+import Queue
+import copy
+import timeit
+import optparse
+import threading
+import collections
+import SocketServer
+import multiprocessing
+
+
+# The positions where two tokens begin to mismatch from the front (head)
+# and back (tail), with their sum, shortfall and lengths.
+HeadTail = collections.namedtuple(
+        'HeadTail', 'head tail both diff Clen Rlen Nmin')
+
+
+class Context(object):
+    # The state of one call, kept off the shared Similar instance.
+    # using maps arbor levels to the letter of the algorithm matching there.
+    # trace is the Tracer recording this call, or None when it is not sampled.
+
+    __slots__ = ('using', 'transforms', 'trace')
+
+    def __init__(self, trace=None):
+        self.using = {}
+        self.transforms = ''
+        self.trace = trace
+
+
+class LRU(object):
+    # A size-bounded least-recently-used cache.
+    # Counters of hits, misses and evictions are kept for tuning the size.
+    # A lock makes it safe to share between threads.
+
+    def __init__(self, size):
+        self.size = size
+        self.table = collections.OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def get(self, key, default=None):
+        # Fetch a value and mark it as most recently used.
+        with self.lock:
+            try:
+                value = self.table.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.table[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        # Store a value, evicting the least recently used beyond size.
+        with self.lock:
+            self.table.pop(key, None)
+            self.table[key] = value
+            if len(self.table) > self.size:
+                self.table.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.table.clear()
+
+    def counts(self):
+        return {
+                'size'     : len(self.table),
+                'hits'     : self.hits,
+                'misses'   : self.misses,
+                'evictions': self.evictions}
+
+
+class Statistics(object):
+    # Opt-in profiling counters of a Similar instance.
+    # For each algorithm letter: calls, hits, and cumulative seconds.
+    # For each arbor level: visits, and candidate children scanned.
+    # For each way a call was answered: acronym, trie, cache or none.
+
+    def __init__(self):
+        self.algorithms = {}
+        self.levels = {}
+        self.answers = {}
+        self.lock = threading.Lock()
+
+    def timed(self, letter, algorithm):
+        # Wrap an algorithm so that its calls are counted and timed.
+        counts = self.algorithms.setdefault(
+                letter, {'calls': 0, 'hits': 0, 'seconds': 0.0})
+        timer = timeit.default_timer
+
+        def wrapper(canon, rough):
+            start = timer()
+            found = algorithm(canon, rough)
+            elapsed = timer() - start
+            with self.lock:
+                counts['calls'] += 1
+                counts['hits'] += bool(found)
+                counts['seconds'] += elapsed
+            return found
+        wrapper.algorithm = algorithm
+        return wrapper
+
+    def scan(self, level, scanned):
+        # Count a visit to an arbor level and the children it scanned.
+        with self.lock:
+            counts = self.levels.setdefault(level, {'visits': 0, 'scanned': 0})
+            counts['visits'] += 1
+            counts['scanned'] += scanned
+
+    def answer(self, how):
+        with self.lock:
+            self.answers[how] = self.answers.get(how, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                    'algorithms': copy.deepcopy(self.algorithms),
+                    'levels': copy.deepcopy(self.levels),
+                    'answers': dict(self.answers)}
+
+
+class Tracer(threading.Thread):
+    # A thread writing structured trace records as lines of JSON.
+    # Records are dicts built by the caller, and only for sampled calls
+    # (one in sample), so tracing costs nothing on calls left out.
+    # emit never blocks the matching thread: records are queued,
+    # dropped (and counted) when the queue is full,
+    # and written here in batches of up to batch records.
+
+    def __init__(self, stream, sample=1, batch=1000, size=100000):
+        threading.Thread.__init__(self, name='Tracer')
+        self.daemon = True
+        self.stream, self.sample, self.batch = stream, max(1, sample), batch
+        self.queue = Queue.Queue(size)
+        self.calls = itertools.count()
+        self.dropped = 0
+        self.start()
+
+    def sampled(self):
+        # Decide whether the next call is traced.
+        return next(self.calls) % self.sample == 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def format(self, record):
+        try:
+            return json.dumps(record, sort_keys=True) + '\n'
+        except UnicodeDecodeError:
+            return json.dumps(record, sort_keys=True, encoding='latin-1') + '\n'
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while records[-1] is not None and len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.stream.writelines([self.format(record)
+                    for record in records if record is not None])
+                self.stream.flush()
+            except ValueError:
+                # The stream was closed under us; the records are lost.
+                pass
+            if records[-1] is None:
+                return
+
+    def close(self):
+        # Write every record emitted so far and stop the thread.
+        self.queue.put(None)
+        self.join()
+
+
+class Vocabulary(object):
+    # The interned tokens of a dictionary, each given an integer id.
+    # Arbor edges and the acronym table are keyed by token ids,
+    # and lexed queries are encoded to ids once, leaving unknown tokens as is.
+    # The features of each token (its keys in every secondary index:
+    # length, first and last letters, phonetic codes and deletions)
+    # are kept in a dense list indexed by id, made when first asked for.
+
+    def __init__(self, generate_keys, tokens=()):
+        self.generate_keys = generate_keys
+        self.tokens = []
+        self.ids = {}
+        self.features = []
+        self.trie = None
+        for token in tokens:
+            self.intern(token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token):
+        # Return the id of a token, giving it the next one if it is new.
+        i = self.ids.get(token)
+        if i is None:
+            i = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            self.features.append(None)
+            if self.trie is not None:
+                self.trie.add(token, i)
+        return i
+
+    def get(self, token, default=None):
+        return self.ids.get(token, default)
+
+    def encode(self, sequence):
+        # Replace the known tokens of a lexed sequence with their ids.
+        ids = self.ids
+        return [ids.get(token, token) for token in sequence]
+
+    def word(self, token):
+        # The token of an encoded sequence element.
+        return self.tokens[token] if isinstance(token, int) else token
+
+    def characters(self):
+        # The character trie of every token, made when first asked for.
+        if self.trie is None:
+            self.trie = CharacterTrie()
+            for i in range(len(self.tokens)):
+                self.trie.add(self.tokens[i], i)
+        return self.trie
+
+    def keys(self, i):
+        # The secondary index keys of a token, a dict of table to keys.
+        keys = self.features[i]
+        if keys is None:
+            keys = self.features[i] = self.generate_keys(self.tokens[i])
+        return keys
+
+    def sorted(self):
+        # Make a copy numbering tokens in order, so that ids sort as tokens,
+        # and the list mapping each id here to the id there.
+        vocabulary = Vocabulary(self.generate_keys, sorted(self.tokens))
+        remap = [vocabulary.ids[token] for token in self.tokens]
+        for i, keys in enumerate(self.features):
+            vocabulary.features[remap[i]] = keys
+        return vocabulary, remap
+
+    @classmethod
+    def mapped(cls, tokens, generate_keys):
+        # Make a vocabulary of a sorted MappedStrings token table.
+        # Features are then made as asked for, and kept in a dict.
+        vocabulary = cls(generate_keys)
+        vocabulary.tokens = vocabulary.ids = tokens
+        vocabulary.features = collections.defaultdict(lambda: None)
+        return vocabulary
+
+
+class CharacterTrie(object):
+    # A trie of the characters of tokens, for bounded edit distance search.
+    # A node is a list of its children (a dict of character to node),
+    # the id of the token ending there or -1, and the fewest and most
+    # letters left in the tokens under it.
+
+    def __init__(self):
+        self.root = [{}, -1, sys.maxint, 0]
+
+    def add(self, token, i):
+        node, left = self.root, len(token)
+        for c in token:
+            node[2], node[3] = min(node[2], left), max(node[3], left)
+            node = node[0].setdefault(c, [{}, -1, sys.maxint, 0])
+            left -= 1
+        node[1], node[2] = i, 0
+
+    def within(self, word, k):
+        # Return a dict of the id of every token within edit distance k
+        # of word to its distance.  An edit inserts, deletes or replaces
+        # a letter, or swaps two adjacent ones.  The trie is walked once,
+        # each row of the distance table being shared by every token
+        # under its prefix.  A prefix is left once no cell of its row,
+        # with the difference in letters left after it, is within k.
+        found = {}
+        n, far = len(word), k + 1
+        first = range(min(n, k) + 1) + [far] * max(0, n - k)
+        stack = [(child, c, None, first, None, 1)
+                for c, child in self.root[0].iteritems()]
+        while stack:
+            node, c, previous, above, before, depth = stack.pop()
+            # Cells further than k from the diagonal exceed k; only the
+            # band about it is computed, the rest held at k + 1.
+            row = [far] * (n + 1)
+            shortest, longest = node[2], node[3]
+            alive = False
+            if depth <= k:
+                row[0] = depth
+                alive = depth + max(0, shortest - n, n - longest) <= k
+            for i in xrange(max(1, depth - k), min(n, depth + k) + 1):
+                value = above[i-1] + (word[i-1] != c)
+                if above[i] < value:
+                    value = above[i] + 1
+                if row[i-1] < value:
+                    value = row[i-1] + 1
+                if (before is not None and i > 1 and word[i-1] == previous
+                        and word[i-2] == c and before[i-2] < value):
+                    value = before[i-2] + 1
+                row[i] = value
+                if not alive and value <= k:
+                    rest = n - i
+                    alive = value + max(
+                            0, shortest - rest, rest - longest) <= k
+            if node[1] >= 0 and row[n] <= k:
+                found[node[1]] = row[n]
+            if alive:
+                for d, child in node[0].iteritems():
+                    stack.append((child, d, c, row, above, depth + 1))
+        return found
+
+
+class Branch(dict):
+    # A node of the dictionary arbor.
+    # Child token ids are keys, mixed in with the metadata keys below.
+    # Secondary indexes over the child tokens are kept as attributes
+    # so that the dictionary contents are unchanged by them.
+
+    metadata = (u'#', u'.', u'.soundex4', u'.dmeta')
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        # Each child token and its single-deletion variants to the child.
+        self.deletes = {}
+        # Phonetic codes of each child token to the child.
+        self.soundex = {}
+        self.metaphone = {}
+        self.NYSSIS = {}
+        # Length, first letter, and last letter of each child to the child.
+        self.lengths = {}
+        self.leads = {}
+        self.tails = {}
+
+    def children(self):
+        # List child token ids, leaving out the metadata keys.
+        return [key for key in self if key not in Branch.metadata]
+
+    def index(self, table, keys, token):
+        # Record a child token id under each of keys in the named index.
+        postings = getattr(self, table)
+        for key in keys:
+            postings.setdefault(key, []).append(token)
+
+    def unindex(self, table, keys, token):
+        # Forget a child token id under each of keys in the named index.
+        postings = getattr(self, table)
+        for key in keys:
+            tokens = postings.get(key)
+            if tokens and token in tokens:
+                tokens.remove(token)
+                if not tokens:
+                    del postings[key]
+
+    def lookup(self, table, keys):
+        # Generate child token ids recorded under any of keys in the index.
+        postings = getattr(self, table)
+        for key in keys:
+            for token in postings.get(key, ()):
+                yield token
+
+
+class BloomBranch(object):
+    # A Bloom filter over the child token ids of a branch and the keys
+    # of its secondary indexes, standing in for the branch with the
+    # candidate finders.  A finder then offers a child (None) only
+    # when some child may have one of its keys.  Membership may be
+    # wrongly claimed, about once in a hundred, but never wrongly denied.
+    # Each item sets hashes bits, at bits per item.
+
+    def __init__(self, branch, vocabulary, bits=10, hashes=7):
+        items = []
+        for token in branch.children():
+            items.append(token)
+            for table, keys in vocabulary.keys(token).iteritems():
+                items.extend([(table, key) for key in keys])
+        self.empty = not items
+        self.size = max(64, bits * len(items))
+        self.hashes = hashes
+        self.bits = bytearray((self.size + 7) // 8)
+        for item in items:
+            for n in self.positions(item):
+                self.bits[n >> 3] |= 1 << (n & 7)
+
+    def positions(self, item):
+        # The bits of an item, by double hashing.
+        h1, h2 = hash(item), hash((item, 1)) | 1
+        return [(h1 + n*h2) % self.size for n in range(self.hashes)]
+
+    def __contains__(self, item):
+        bits = self.bits
+        for n in self.positions(item):
+            if not bits[n >> 3] & (1 << (n & 7)):
+                return False
+        return True
+
+    def children(self):
+        return [] if self.empty else [None]
+
+    def lookup(self, table, keys):
+        for key in keys:
+            if (table, key) in self:
+                yield None
+                return
+
+
+class FrozenArbor(object):
+    # A compact, read-only form of an arbor of Branch dicts.
+    # Token ids are those of a sorted Vocabulary, so an id orders like its
+    # token, and remap gives them for the ids of the Branch arbor.
+    # Nodes are numbered breadth first from 0.
+    # The edges of node n are offsets[n] to offsets[n+1], sorted by token id,
+    # edges[e] holding the token id and targets[e] the child node.
+    # Heights are a column of their own, and canons is a column of indices
+    # into metadata, which holds ('.', '.soundex4', '.dmeta') per canonical.
+    # Secondary indexes map a key to the sorted ids of every token having it.
+
+    def __init__(self, root, vocabulary, remap):
+        self.heights = array.array('i')
+        self.canons = array.array('i')
+        self.offsets = array.array('i', [0])
+        self.edges = array.array('i')
+        self.targets = array.array('i')
+        self.metadata = []
+        nodes, tokens = [root], set()
+        for branch in nodes:
+            self.heights.append(branch.get(u'#', 0))
+            if branch.get(u'.'):
+                self.canons.append(len(self.metadata))
+                self.metadata.append(tuple(
+                    [branch.get(key) for key in Branch.metadata[1:]]))
+            else:
+                self.canons.append(-1)
+            for token, child in sorted([(remap[child], child)
+                    for child in branch.children()]):
+                tokens.add(token)
+                self.edges.append(token)
+                self.targets.append(len(nodes))
+                nodes.append(branch[child])
+            self.offsets.append(len(self.edges))
+
+        self.postings = {}
+        for token in sorted(tokens):
+            for table, keys in vocabulary.keys(token).iteritems():
+                postings = self.postings.setdefault(table, {})
+                for key in keys:
+                    postings.setdefault(key, array.array('i')).append(token)
+
+    def root(self):
+        return FrozenBranch(self, 0)
+
+    columns = ('heights', 'canons', 'offsets', 'edges', 'targets')
+
+    def sections(self):
+        # Generate the (name, bytes) sections saving this arbor.
+        sections = []
+        for name in FrozenArbor.columns:
+            sections.append((name, IndexFile.pack_ints(getattr(self, name))))
+        columns = {
+                'canon'    : lambda meta: meta[0],
+                'soundex4' : lambda meta: meta[1],
+                'primary'  : lambda meta: meta[2][0],
+                'secondary': lambda meta: meta[2][1]}
+        for name, column in sorted(columns.iteritems()):
+            sections += IndexFile.pack_strings('metadata.' + name,
+                    [column(meta) or '' for meta in self.metadata])
+        for table in sorted(self.postings):
+            sections += IndexFile.pack_postings(
+                    'postings.' + table, self.postings[table])
+        return sections
+
+    @classmethod
+    def mapped(cls, index):
+        # Make an arbor reading its columns straight from an IndexFile.
+        arbor = cls.__new__(cls)
+        for name in FrozenArbor.columns:
+            setattr(arbor, name, index.ints(name))
+        arbor.metadata = MappedMetadata([index.strings('metadata.' + name)
+            for name in ['canon', 'soundex4', 'primary', 'secondary']])
+        arbor.postings = {}
+        for name in index.sections:
+            if name.startswith('postings.') and name.endswith('.ids'):
+                table = name[len('postings.'):-len('.ids')]
+                arbor.postings[table] = index.postings('postings.' + table)
+        return arbor
+
+
+class FrozenBranch(object):
+    # A node of a FrozenArbor with the interface of a Branch.
+
+    __slots__ = ('arbor', 'node')
+
+    def __init__(self, arbor, node):
+        self.arbor = arbor
+        self.node = node
+
+    def edge(self, token):
+        # Find the edge to a child token id, or -1 when there is none.
+        if not isinstance(token, int):
+            return -1
+        arbor = self.arbor
+        lo, hi = arbor.offsets[self.node], arbor.offsets[self.node+1]
+        e = bisect.bisect_left(arbor.edges, token, lo, hi)
+        return e if e < hi and arbor.edges[e] == token else -1
+
+    def __getitem__(self, key):
+        arbor = self.arbor
+        if key in Branch.metadata:
+            if key == u'#':
+                return arbor.heights[self.node]
+            canon = arbor.canons[self.node]
+            if canon < 0:
+                raise KeyError(key)
+            return arbor.metadata[canon][Branch.metadata.index(key) - 1]
+        e = self.edge(key)
+        if e < 0:
+            raise KeyError(key)
+        return FrozenBranch(arbor, arbor.targets[e])
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def children(self):
+        # List child token ids.
+        arbor = self.arbor
+        lo, hi = arbor.offsets[self.node], arbor.offsets[self.node+1]
+        return list(arbor.edges[lo:hi])
+
+    def lookup(self, table, keys):
+        # Generate child token ids having any of keys in the named index.
+        # The smaller of the postings and the edges is walked,
+        # and each of its ids is searched for in the other.
+        arbor = self.arbor
+        edges, postings = arbor.edges, arbor.postings.get(table, {})
+        lo, hi = arbor.offsets[self.node], arbor.offsets[self.node+1]
+        for key in keys:
+            posting = postings.get(key, ())
+            if len(posting) <= hi - lo:
+                for token in posting:
+                    e = bisect.bisect_left(edges, token, lo, hi)
+                    if e < hi and edges[e] == token:
+                        yield token
+            else:
+                for token in edges[lo:hi]:
+                    p = bisect.bisect_left(posting, token)
+                    if p < len(posting) and posting[p] == token:
+                        yield token
+
+
+class MappedArray(object):
+    # A read-only int32 array inside a buffer such as an mmap.
+
+    __slots__ = ('buf', 'offset', 'count')
+
+    item = struct.Struct('<i')
+
+    def __init__(self, buf, offset, count):
+        self.buf, self.offset, self.count = buf, offset, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            lo, hi, step = i.indices(self.count)
+            if hi <= lo:
+                return []
+            return list(struct.unpack_from(
+                '<%di' % (hi - lo), self.buf, self.offset + 4*lo))
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return MappedArray.item.unpack_from(self.buf, self.offset + 4*i)[0]
+
+    def __iter__(self):
+        return iter(self[0:self.count])
+
+    def view(self, lo, hi):
+        # A sub-array sharing the same buffer.
+        return MappedArray(self.buf, self.offset + 4*lo, hi - lo)
+
+
+class MappedStrings(object):
+    # A read-only table of strings inside a buffer.
+    # Each string is tagged 'u' for unicode (stored as UTF-8) or 'b' for str.
+    # When the table is sorted, get finds the position of a string.
+
+    __slots__ = ('buf', 'index', 'data')
+
+    def __init__(self, buf, index, data):
+        self.buf, self.index, self.data = buf, index, data
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        lo, hi = self.index[i:i+2]
+        raw = self.buf[self.data + lo:self.data + hi]
+        return raw[1:].decode('utf-8') if raw[:1] == 'u' else raw[1:]
+
+    def get(self, word, default=None):
+        i = bisect.bisect_left(self, word)
+        if i < len(self) and self[i] == word:
+            return i
+        return default
+
+
+class MappedPostings(object):
+    # A read-only secondary index: sorted keys, each with a range of ids.
+    # Keys of any type are stored and looked up as unicode.
+
+    __slots__ = ('keys', 'offsets', 'ids')
+
+    def __init__(self, keys, offsets, ids):
+        self.keys, self.offsets, self.ids = keys, offsets, ids
+
+    def get(self, key, default=None):
+        i = self.keys.get(unicode(key))
+        if i is None:
+            return default
+        lo, hi = self.offsets[i:i+2]
+        return self.ids.view(lo, hi)
+
+
+class MappedMetadata(object):
+    # A read-only column of ('.', '.soundex4', '.dmeta') metadata.
+
+    __slots__ = ('columns',)
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, i):
+        canon, soundex4, primary, secondary = [
+                column[i] for column in self.columns]
+        return canon, soundex4, [primary or None, secondary or None]
+
+
+class MappedAcronyms(object):
+    # A read-only acronym table: sorted acronym token ids,
+    # each with a set of names.
+
+    __slots__ = ('ids', 'offsets', 'values')
+
+    def __init__(self, ids, offsets, values):
+        self.ids, self.offsets, self.values = ids, offsets, values
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, token):
+        # The position of an acronym token id, or -1 when it is not one.
+        if not isinstance(token, int):
+            return -1
+        i = bisect.bisect_left(self.ids, token)
+        return i if i < len(self.ids) and self.ids[i] == token else -1
+
+    def __getitem__(self, token):
+        i = self.find(token)
+        if i < 0:
+            raise KeyError(token)
+        lo, hi = self.offsets[i:i+2]
+        return set(self.values[lo:hi])
+
+    def get(self, token, default=None):
+        try:
+            return self[token]
+        except KeyError:
+            return default
+
+    def __contains__(self, token):
+        return self.find(token) >= 0
+
+    def items(self):
+        # List (key, set) pairs, in key order.
+        offsets, values = self.offsets, self.values
+        return [(self.ids[i], set(values[offsets[i]:offsets[i+1]]))
+                for i in range(len(self.ids))]
+
+
+class MappedSets(MappedAcronyms):
+    # A read-only table of string keys (in ids) sorted by collation,
+    # each with a set of strings, such as the join and alias tables.
+
+    __slots__ = ()
+
+    def find(self, key):
+        # The position of a key, or -1 when it is not one.
+        keys, target = self.ids, collation(key)
+        lo, hi = 0, len(keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if collation(keys[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(keys) and collation(keys[lo]) == target else -1
+
+
+class IndexFile(object):
+    # A saved index: named sections of int32 arrays and string tables.
+    # Layout: magic, version and section count, a directory of
+    # (name, offset, length) entries, then the 8-byte aligned sections.
+    # All integers are little-endian.  The file is memory-mapped read-only,
+    # so its pages are shared by every process mapping it.
+
+    magic = 'SIMILAR\0'
+    version = 5
+    header = struct.Struct('<8sII')
+    entry = struct.Struct('<64sQQ')
+
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            self.buf = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = IndexFile.header.unpack_from(self.buf, 0)
+        if magic != IndexFile.magic:
+            raise ValueError('"%s" is not a Similar index' % (path))
+        if version != IndexFile.version:
+            raise ValueError('"%s" has index version %d, not %d' % (
+                path, version, IndexFile.version))
+        self.sections = {}
+        for n in range(count):
+            name, offset, length = IndexFile.entry.unpack_from(
+                    self.buf, IndexFile.header.size + n*IndexFile.entry.size)
+            self.sections[name.rstrip('\0')] = (offset, length)
+
+    def ints(self, name):
+        offset, length = self.sections[name]
+        return MappedArray(self.buf, offset, length // 4)
+
+    def strings(self, name):
+        return MappedStrings(
+                self.buf, self.ints(name + '.index'),
+                self.sections[name + '.data'][0])
+
+    def postings(self, name):
+        return MappedPostings(
+                self.strings(name + '.keys'),
+                self.ints(name + '.offsets'),
+                self.ints(name + '.ids'))
+
+    def sets(self, name):
+        return MappedSets(
+                self.strings(name + '.keys'),
+                self.ints(name + '.offsets'),
+                self.strings(name + '.values'))
+
+    @staticmethod
+    def pack_ints(values):
+        ints = array.array('i', values)
+        if sys.byteorder == 'big':
+            ints.byteswap()
+        return ints.tostring()
+
+    @staticmethod
+    def pack_strings(name, values):
+        # Generate the index and data sections of a string table.
+        index, data, offset = [0], [], 0
+        for value in values:
+            if isinstance(value, unicode):
+                raw = 'u' + value.encode('utf-8')
+            else:
+                raw = 'b' + value
+            data.append(raw)
+            offset += len(raw)
+            index.append(offset)
+        return [(name + '.index', IndexFile.pack_ints(index)),
+                (name + '.data', string.join(data, ''))]
+
+    @staticmethod
+    def pack_postings(name, table):
+        # Generate the sections of a secondary index.
+        keys = sorted(table, key=unicode)
+        offsets, ids = [0], []
+        for key in keys:
+            ids.extend(table[key])
+            offsets.append(len(ids))
+        return (IndexFile.pack_strings(name + '.keys', map(unicode, keys)) + [
+                (name + '.offsets', IndexFile.pack_ints(offsets)),
+                (name + '.ids', IndexFile.pack_ints(ids))])
+
+    @staticmethod
+    def pack_sets(name, table):
+        # Generate the sections of a table of strings to sets of strings.
+        # Byte str and unicode strings are sorted together by collation.
+        keys = sorted(table, key=collation)
+        offsets, values = [0], []
+        for key in keys:
+            values.extend(sorted(table[key], key=collation))
+            offsets.append(len(values))
+        return (IndexFile.pack_strings(name + '.keys', keys) +
+                [(name + '.offsets', IndexFile.pack_ints(offsets))] +
+                IndexFile.pack_strings(name + '.values', values))
+
+    @staticmethod
+    def write(path, sections):
+        # Write (name, bytes) sections as an index file.
+        offset = IndexFile.header.size + len(sections)*IndexFile.entry.size
+        directory, blocks = [], []
+        for name, data in sections:
+            offset += -offset % 8
+            directory.append(IndexFile.entry.pack(name, offset, len(data)))
+            blocks.append(data)
+            offset += len(data)
+        with open(path, 'wb') as target:
+            target.write(IndexFile.header.pack(
+                IndexFile.magic, IndexFile.version, len(sections)))
+            target.writelines(directory)
+            for block in blocks:
+                target.write('\0' * (-target.tell() % 8))
+                target.write(block)
+
+
+class LexTable(dict):
+    # The unicode.translate table of the lexer, folding Unicode to ASCII.
+    # ASCII translates as in the byte table.  Other code points have
+    # their compatibility decomposition (ligatures, full width forms...)
+    # with diacritics dropped and letters uppercased.  Letters having no
+    # decomposition are spelled out from the given table or kept as they
+    # are, and anything else separates tokens.
+    # The Latin blocks are folded up front, other code points when first seen.
+
+    def __init__(self, lex, spelled):
+        dict.__init__(self)
+        self.lex, self.spelled = lex, spelled
+        for o in range(0x250):
+            self[o] = self.fold(o)
+
+    def fold(self, o):
+        if o < 128:
+            return unicode(self.lex[o])
+        c = unichr(o)
+        if c in self.spelled:
+            return self.spelled[c]
+        folded = u''
+        for d in unicodedata.normalize('NFKD', c):
+            category = unicodedata.category(d)[0]
+            if d == u',':
+                # A comma only ever separates the lines of a block.
+                folded += u' '
+            elif ord(d) < 128:
+                folded += self.lex[ord(d)]
+            elif category == 'L':
+                folded += d.upper()
+            elif category != 'M':
+                folded += u' '
+        return folded
+
+    def __missing__(self, o):
+        folded = self[o] = self.fold(o)
+        return folded
+
+
+class Keyboard(object):
+    # The fat finger tables of one or more keyboard layouts, each a dict
+    # of the letter of each key to the characters on or next to it.
+    # Layouts are merged with a bit per layout, so one pass over a token
+    # tells which layouts explain it, and a token must be explained by
+    # one layout, as a clerk types it on one keyboard.
+    # table, indexed by ord(rough) + (ord(canon) << 8), holds the bits
+    # of the layouts on which the rough character may have been struck
+    # for the canonical one.  bits maps every (canonical, rough) pair to
+    # them, neighbors maps each canonical character to its set of them,
+    # and pairs holds every pair, to check whole tokens.
+    # A set of layouts is compiled once per process and shared by every
+    # instance.
+
+    compiled = {}
+
+    def __init__(self, names, layouts):
+        if len(layouts) > 8:
+            raise ValueError('at most 8 keyboard layouts are merged')
+        self.names = tuple(names)
+        self.mask = (1 << len(layouts)) - 1
+        self.table = bytearray(65536)
+        self.bits = {}
+        for bit, layout in enumerate(layouts):
+            for intended, keys in layout.iteritems():
+                for key in keys:
+                    pair = (intended, key)
+                    self.bits[pair] = self.bits.get(pair, 0) | 1 << bit
+                    if ord(key) < 256 and ord(intended) < 256:
+                        self.table[ord(key) + (ord(intended) << 8)] |= (
+                                1 << bit)
+        self.neighbors = {}
+        for intended, key in self.bits:
+            self.neighbors.setdefault(intended, set()).add(key)
+        for intended, keys in self.neighbors.iteritems():
+            self.neighbors[intended] = frozenset(keys)
+        self.pairs = frozenset(self.bits)
+
+    @classmethod
+    def compile(cls, names, layouts):
+        names = tuple(names)
+        keyboard = cls.compiled.get(names)
+        if keyboard is None:
+            keyboard = cls.compiled[names] = cls(names, layouts)
+        return keyboard
+
+    @staticmethod
+    def layout(rows):
+        # Make a layout from the geometry of a keyboard, a list of rows
+        # from the top, each an (offset, unshifted, shifted) triple of
+        # the left edge of its first key in key widths and the characters
+        # on its keys, a space for none.  Keys whose centers are less than
+        # the square root of two key widths apart are neighbors: the next
+        # keys in a row and the two overlapping each in the rows beside it.
+        keys = []
+        for row, (offset, unshifted, shifted) in enumerate(rows):
+            for column, characters in enumerate(
+                    itertools.izip(unshifted, shifted)):
+                characters = [c for c in characters if c != u' ']
+                characters += [c.upper() for c in characters
+                        if c.isalpha() and c.upper() not in characters]
+                keys.append((row, offset + column, characters))
+        layout = {}
+        for row, x, characters in keys:
+            near = [c for r, y, others in keys
+                    if (r - row) ** 2 + (y - x) ** 2 < 2 for c in others]
+            for c in characters:
+                if c.isalpha() and c.isupper():
+                    layout[c] = string.join(near, u'')
+        return layout
+
+    def explain(self, canon, rough):
+        # The bits of the layouts on which every character of rough
+        # differing from the one of canon in its place was next to it.
+        mask, bits = self.mask, self.bits
+        for pair in itertools.izip(canon, rough):
+            if pair[0] != pair[1]:
+                mask &= bits.get(pair, 0)
+                if not mask:
+                    break
+        return mask
+
+    def explained(self, canon, rough):
+        # The names of the layouts explaining rough typed for canon.
+        if len(canon) != len(rough):
+            return []
+        mask = self.explain(canon, rough)
+        return [name for bit, name in enumerate(self.names)
+                if mask & 1 << bit]
+
+    def near(self, canon, rough):
+        # Whether every character of rough may have been struck for
+        # the one of canon in its place, in one pass over the tokens
+        # and another over the differing characters for several layouts.
+        if not self.pairs.issuperset(itertools.izip(canon, rough)):
+            return False
+        return self.mask == 1 or bool(self.explain(canon, rough))
+
+    def misses(self, canon, rough):
+        # The number of keys struck next to the intended ones,
+        # or None when any was further away.  Only differing characters
+        # are looked up, so the same character always matches.
+        missed = [pair for pair in itertools.izip(canon, rough)
+                if pair[0] != pair[1]]
+        if not self.pairs.issuperset(missed):
+            return None
+        if self.mask != 1 and not self.explain(canon, rough):
+            return None
+        return len(missed)
 
 
 class Similar(dict):
@@ -82,9 +1088,9 @@ class Similar(dict):
             D, D, D, D,  D, D, D, D,   D, D, O, S,  O, O, O, O, # 30
 
             O, A, A, A,  A, A, A, A,   A, A, A, A,  A, A, A, A, # 40
-            A, A, A, A,  A, A, A, A,   A, A, O, T,  T, O, O, O, # 50
+            A, A, A, A,  A, A, A, A,   A, A, A, T,  T, O, O, O, # 50
             O, A, A, A,  A, A, A, A,   A, A, A, A,  A, A, A, A, # 60
-            A, A, A, A,  A, A, A, A,   A, A, O, T,  O, O, O, X, # 70
+            A, A, A, A,  A, A, A, A,   A, A, A, T,  O, O, O, X, # 70
 
             X, X, X, X,  X, X, X, X,   X, X, X, X,  X, X, X, X, # 80
             X, X, X, X,  X, X, X, X,   X, X, X, X,  X, X, X, X, # 90
@@ -153,6 +1159,28 @@ class Similar(dict):
              '' , '' , '' , '' , '' , '' , '' , '' , # F7-FF
            ]
 
+    # Tables of the bulk lexer, derived from the two above.
+    # Lexing stops at the first character matching CUT.
+    # LEX translates letters to uppercase, keeps apostrophes and hyphens,
+    # flags other token characters (not ASCII) as '\x01',
+    # makes the comma separating the lines of a block a comma,
+    # and makes everything else a space separating tokens.
+    # Flagged strings are decoded and lexed by LEX_UNICODE instead.
+    CUT = re.compile('[%s]' % string.join([re.escape(chr(o))
+        for o in range(256) if ASCII[o] in (T, R, C)], ''))
+    LEX = string.join([',' if o == ord(',') else XLAT[o] or (
+        '\x01' if ASCII[o] >= A else ' ') for o in range(256)], '')
+
+    # Letters without a Unicode decomposition, spelled out in ASCII.
+    SPELLED = {
+            u'\xc6': u'AE', u'\xe6': u'AE', u'\u0152': u'OE', u'\u0153': u'OE',
+            u'\xdf': u'SS', u'\xde': u'TH', u'\xfe': u'TH',
+            u'\xd0': u'D',  u'\xf0': u'D',  u'\u0110': u'D', u'\u0111': u'D',
+            u'\xd8': u'O',  u'\xf8': u'O',  u'\u0141': u'L', u'\u0142': u'L',
+            u'\u0126': u'H', u'\u0127': u'H', u'\u0131': u'I',
+            }
+    LEX_UNICODE = LexTable(LEX, SPELLED)
+
     # Map qwerty keyboard to possible fat_fingerings.
     QWERTY = {
             # These are lists of all keys within a one key radius of center.
@@ -216,113 +1244,126 @@ class Similar(dict):
             'Z': 'ZzVvSs-',
     }
 
+    # Map AZERTY (French) and QWERTZ (German) keyboards to possible
+    # fat_fingerings, generated from the rows of their keys (ISO).
+    AZERTY = Keyboard.layout([
+            (0.00, u'\xb2&\xe9"\'(-\xe8_\xe7\xe0)=', u' 1234567890\xb0+'),
+            (1.50, u'azertyuiop^$',   u'AZERTYUIOP\xa8\xa3'),
+            (1.75, u'qsdfghjklm\xf9*', u'QSDFGHJKLM%\xb5'),
+            (1.25, u'<wxcvbn,;:!',    u'>WXCVBN?./\xa7'),
+            ])
+
+    QWERTZ = Keyboard.layout([
+            (0.00, u'^1234567890\xdf\xb4', u'\xb0!"\xa7$%&/()=?`'),
+            (1.50, u'qwertzuiop\xfc+',   u'QWERTZUIOP\xdc*'),
+            (1.75, u'asdfghjkl\xf6\xe4#', u"ASDFGHJKL\xd6\xc4'"),
+            (1.25, u'<yxcvbnm,.-',      u'>YXCVBNM;:_'),
+            ])
+
     keyboard = {
             # This dictionary enables consideration of alternate keyboards.
             'QWERTY': QWERTY,
-            'DVORAK': DVORAK
+            'DVORAK': DVORAK,
+            'AZERTY': AZERTY,
+            'QWERTZ': QWERTZ
             }
 
     stopwords = [u'THE', u'OF', u'AND', u'FOR', u'INC', u'--']
 
-    ABIM = 'American Board of Internal Medicine'
+    # The controls changing what matches, without calling invalidate.
+    matching_controls = ('algorithms', 'joins', 'bloom', 'keyboard')
+
+    # Phonetic algorithm letters and the Branch index each one uses.
+    phonetics = {'s': 'soundex', 'm': 'metaphone', 'N': 'NYSSIS'}
+
+    # Cost factors of the scored search, by algorithm letter.
+    # A path through the arbor scores the product of the factors of its
+    # matches, so the least product is the best fit.  Every factor is
+    # at least 1, so a partial product bounds any score below it,
+    # and an algorithm never matches differing tokens for less than its own.
+    # 'f' is paid per key struck, 'c' grows with the letters left out,
+    # '.' is an exact edge, 'A' an acronym, and '-' is paid for each
+    # token left over past a canonical name.  'J' is paid for each word
+    # boundary lost between edges run together, and 'S' for one added.
+    # '=' is a known variant, an alias.
+    costs = {
+            '.': 1.0, 'e': 1.0, 'f': 1.25, 'L': 1.5, 'K': 1.5, 'c': 1.5,
+            'm': 2.5, 'N': 2.5, 's': 3.0, 'A': 2.0, '-': 4.0,
+            'J': 1.5, 'S': 1.5, '=': 1.0,
+            }
 
-    def bool_report(self, TF, title, word, canon=None, **kw):
-        # A function to generate regular output to the log file.
-        used = kw.get('used', '')
-        if used:
-            octothorpe = 79 - len(used)
-            if octothorpe < 1:
-                octothorpe = 1
-            print>>self.log, used, '#' * octothorpe
-        elif TF and self.log:
-            # Log result and return True
-            if self.log:
-                tab, tabs = '  ', int(kw.get('tabs', 1))
-                indent = tab * tabs
-                tab = tab if not tabs else ''
-                qword = '"%s"' % (word)
-                if canon:
-                    qcanon = '"%s"' % (canon)
-                    print>>self.log, '%s%-24s  %s%32s : %s' % (
-                            indent, title, tab, qword, qcanon)
-                else:
-                    print>>self.log, '%s%-24s  %s%32s' % (
-                            indent, title, tab, qword)
-        return TF
+    # The edit distance allowed by the 'K' algorithm for a token
+    # of at least so many letters.  'K' pays its factor per edit.
+    distances = ((16, 3), (8, 2), (0, 1))
+
+    ABIM = 'American Board of Internal Medicine'
 
     # This is the table-driven lexer.
     def lex_line(self, rough):
-        # Make class statics visible without prefix.
-        A =     Similar.ALPHA
-        C =     Similar.COMMA
-        D =     Similar.DIGIT
-        M =     Similar.MINUS
-        R =     Similar.RATIO
-        S =     Similar.WHITE
-        T =     Similar.TERMS
-        U =     Similar.UCODE
-        ASCII = Similar.ASCII
-        XLAT  = Similar.XLAT
-
-        tokens      = [u''] # Storage for separated words.
-
-        if len(rough):
-            terminators = [T, R, C] # M?
-
-            # Single letter variables are used to compress visual inspection.
-            # c is the current character.
-            # o is used for the ordinal throughout lex.
-            # t is the type of character (either U or indexed from ASCII).
-            # k is the flag for keeping characters (transitions cause new token).
-            # s is the current state of the state machine.
-            c = rough[0]
-            o = ord(c)
-            Unicode = o>255
-            t = U if Unicode else ASCII[o]
-            x = o # * int(not Unicode)
-            k = t >= A
-
-            for c in rough:
-                # A character ordinal is not enough when using Unicode
-                o = ord(c)
-
-                # If it is outside the ASCII range, it is handled differently.
-                Unicode = o>255
-                t = U if Unicode else ASCII[o]
-                x = o * int(not Unicode)
-
-                if t in terminators:
-                    # If character is a terminator or context switcher, stop.
-                    break
-
-                if k:
-                    # If in token building mode, check for transition.
-                    if t < A:
-                        # Leaving token building mode.
-                        k = False
-                elif not k:
-                    # If not in token building mode, check for transition.
-                    if t >= A:
-                        # Entering token building mode
-                        k = True
-                        # Take a list of tokens for identifying Boards
-
-                        if tokens[-1] != u'':
-                            # Eliminate empty tokens
-                            if tokens[-1] in self.stopwords:
-                                # Eliminate stopwords
-                                tokens[-1] = u''
-                            else:
-                                # Begin a new token
-                                tokens.append(u'')
-
-                # Append char to latest each of string and token.
-                # Note that Unicode uses index of zero which is always False.
-                xlat = XLAT[x]
-                tokens[-1] += xlat
-        if tokens[-1] in self.stopwords:
+        # Lex a rough string into a list of uppercase tokens.
+        return self.lex_tokens(self.lex_translate(rough).split())
+
+    def lex_many(self, roughs):
+        # Lex a list of rough strings together, returning a list of token
+        # lists.  The cut lines are joined with commas, which cutting
+        # removed from them, and translated as one block.
+        if not roughs:
+            return []
+        cut = Similar.CUT.split
+        lines = [cut(rough, 1)[0] for rough in roughs]
+        block = None
+        if all([type(line) is str for line in lines]):
+            block = string.join(lines, ',').translate(Similar.LEX)
+        if block is None or '\x01' in block:
+            block = string.join([line if isinstance(line, unicode) else
+                self.decode(line) for line in lines], u',').translate(
+                        Similar.LEX_UNICODE)
+        return [self.lex_tokens(line.split()) for line in block.split(',')]
+
+    def lex_translate(self, rough):
+        # Cut a rough string at its first terminator and translate it.
+        rough = Similar.CUT.split(rough, 1)[0]
+        if isinstance(rough, str):
+            lexed = rough.translate(Similar.LEX)
+            if '\x01' not in lexed:
+                return lexed
+            rough = self.decode(rough)
+        return rough.translate(Similar.LEX_UNICODE)
+
+    def decode(self, rough):
+        # Bytes are taken to be UTF-8 when they can be, else Latin-1.
+        try:
+            return rough.decode('utf-8')
+        except UnicodeDecodeError:
+            return rough.decode('latin-1')
+
+    def ascii(self, text):
+        # Fold a string to ASCII for the phonetic algorithms,
+        # which fail on anything else.  ASCII strings are returned as is.
+        try:
+            text.encode('ascii')
+            return text
+        except UnicodeError:
+            if isinstance(text, str):
+                text = self.decode(text)
+        text = string.join([Similar.SPELLED.get(c, c) for c in text], u'')
+        return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+
+    def lex_tokens(self, runs):
+        # Make tokens of the translated runs of token characters,
+        # dropping stopwords.
+        stopwords = self.stopwords
+        tokens = [u'']
+        for run in runs:
+            if tokens[-1] != u'':
+                if tokens[-1] in stopwords:
+                    tokens[-1] = u''
+                else:
+                    tokens.append(u'')
+            tokens[-1] += run
+        if tokens[-1] in stopwords:
             # In case a final stopword made it past the transition.
-            tokens = tokens[:-1]
+            tokens.pop()
         return tokens
 
     def generate_fat_finger_index(self, C1, C2):
@@ -334,87 +1375,552 @@ class Similar(dict):
         return 0 if Unicode else int(ord(C1))+(int(ord(C2))<<8)
 
     def generate_head_tail_indices(self, canon, rough):
-        # This function moves the head and tail values to
+        # This function finds the head and tail values,
         # the positions from beginning and end where
         # two tokens first begin to mismatch.
-        self.head, self.tail = 0, 0
-        self.Clen, self.Rlen = len(canon), len(rough)
-        self.Nmin = min(self.Clen, self.Rlen)
+        # They are returned rather than kept, so that calls are reentrant.
+        head, tail = 0, 0
+        Clen, Rlen = len(canon), len(rough)
+        Nmin = min(Clen, Rlen)
         # Find the first non-matching location.
-        while self.head < self.Nmin and canon[self.head] == rough[self.head]:
-            self.head += 1
+        while head < Nmin and canon[head] == rough[head]:
+            head += 1
         # Find the last non-matching location.
-        while self.tail < self.Nmin and canon[-1-self.tail] == rough[-1-self.tail]:
-            self.tail += 1
+        while tail < Nmin and canon[-1-tail] == rough[-1-tail]:
+            tail += 1
         # How much head and tail match.
-        self.both = self.head + self.tail
+        both = head + tail
         # How much combined match differs from total length.
-        self.diff = self.Nmin - self.both
+        diff = Nmin - both
+        return HeadTail(head, tail, both, diff, Clen, Rlen, Nmin)
+
+    def generate_deletes(self, word):
+        # This function generates a token and all its single deletions.
+        # Two tokens within Levenshtein distance 1 share at least one.
+        deletes = set([word])
+        for n in range(len(word)):
+            deletes.add(word[:n] + word[n+1:])
+        return deletes
+
+    def generate_distance(self, word):
+        # The number of edits 'K' allows in a token this long.
+        for length, distance in self.distances:
+            if len(word) >= length:
+                return distance
+
+    def generate_near(self, word):
+        # This function finds the vocabulary tokens within edit distance
+        # of a token in one walk of the character trie, as a dict of
+        # token id to distance.  Every branch reached by the token at
+        # one level of a call shares the walk, so it is kept.
+        near = self.near.get(word)
+        if near is None:
+            near = self.vocabulary.characters().within(
+                    word, self.generate_distance(word))
+            self.near[word] = near
+        return near
+
+    def generate_edits(self, canon, rough):
+        # The edit distance between tokens, or None beyond 'K's reach.
+        # A canonical token outside the vocabulary gets a trie of its own.
+        token = self.vocabulary.get(canon)
+        if token is not None:
+            return self.generate_near(rough).get(token)
+        trie = CharacterTrie()
+        trie.add(canon, 0)
+        return trie.within(rough, self.generate_distance(rough)).get(0)
+
+    def generate_candidates(self, branch, word):
+        # This function lists the child token ids of a branch that
+        # any of the chosen algorithms could possibly match with word.
+        # An algorithm with a 'candidates' finder offers only
+        # the children from its index; one without offers them all.
+        candidates, seen = [], set()
+        for letter in self.control.get('algorithms'):
+            finder = self.master_algorithm_list[letter].get('candidates')
+            if not finder:
+                return branch.children()
+            for canon in finder(branch, word):
+                if canon not in seen:
+                    seen.add(canon)
+                    candidates.append(canon)
+        return candidates
+
+    def generate_phonetic(self, letter, word):
+        # This function generates the set of phonetic codes of a token
+        # for the soundex 's', metaphone 'm', or NYSSIS 'N' algorithm.
+        # Codes of vocabulary tokens are among their features, made once.
+        token = self.vocabulary.get(word)
+        if token is not None:
+            return self.vocabulary.keys(token)[Similar.phonetics[letter]]
+        return self.generate_codes(letter, word)
+
+    def generate_codes(self, letter, word):
+        # This function computes the phonetic codes of a token.
+        # Empty codes (no letters) are left out, since they would match all.
+        word = self.ascii(word)
+        if letter == 's':
+            codes = [self.soundex4(word)]
+        elif letter == 'm':
+            codes = self.dmeta(word)
+        else:
+            codes = [fuzzy.nysiis(word)]
+        return set([code for code in codes if code and code != '0000'])
+
+    def generate_index_keys(self, word):
+        # This function generates the keys of a token in each secondary index.
+        # These are the features kept for it by the vocabulary.
+        keys = {
+                'deletes': self.generate_deletes(word),
+                'lengths': [len(word)],
+                'leads'  : [word[:1]],
+                'tails'  : [word[-1:]],
+                }
+        for letter, table in Similar.phonetics.iteritems():
+            keys[table] = self.generate_codes(letter, word)
+        return keys
+
+    def index_child(self, branch, token):
+        # Record a new child token id in the secondary indexes of its branch.
+        for table, keys in self.vocabulary.keys(token).iteritems():
+            branch.index(table, keys, token)
+
+    def unindex_child(self, branch, token):
+        # Forget a removed child token id in the secondary indexes.
+        for table, keys in self.vocabulary.keys(token).iteritems():
+            branch.unindex(table, keys, token)
 
     def generate_acronym(self, sequence):
         # This function jams first letters of tokens into an acronym.
         return string.join([word[0] if word else '' for word in sequence], '')
 
+    def generate_joins(self, runs):
+        # This function generates the (key, run) pairs of the join table
+        # for the translated runs of a name.  A key runs together from 2
+        # to control['joins'] consecutive tokens, with or without the
+        # stopwords between them, and its run is those tokens.
+        stopwords, most = self.stopwords, self.control['joins']
+        for i, first in enumerate(runs):
+            if first in stopwords:
+                continue
+            kept = [first]
+            for j in range(i + 1, len(runs)):
+                if runs[j] in stopwords:
+                    continue
+                kept.append(runs[j])
+                if len(kept) > most:
+                    break
+                run = string.join(kept, ' ')
+                yield string.join(kept, ''), run
+                if len(kept) < j + 1 - i:
+                    yield string.join(runs[i:j+1], ''), run
+
+    def generate_boundaries(self, branch, sequence):
+        # This function generates the ways the next tokens exactly match
+        # edges of a branch when a word boundary was lost or added, as
+        # (letter, edges matched, branch reached, tokens left, edges crossed)
+        # tuples.
+        # 'J' is a token running a path of edges together, found by its
+        # key in the join table, and 'S' two tokens splitting one edge.
+        vocabulary = self.vocabulary
+        word = vocabulary.word(sequence[0])
+        for run in self.joins.get(word) or ():
+            edges, child = run.split(), branch
+            for edge in edges:
+                child = child.get(vocabulary.get(edge))
+                if child is None:
+                    break
+            else:
+                yield 'J', run, child, sequence[1:], len(edges)
+        if len(sequence) > 1:
+            joined = word + vocabulary.word(sequence[1])
+            child = branch.get(vocabulary.get(joined))
+            if child is not None:
+                yield 'S', joined, child, sequence[2:], 1
+
     def fill_arbor(self, rough):
         # Build a dictionary arbor from token lists.
-        sequence = self.lex_line(rough)
+        if isinstance(self.root, FrozenBranch):
+            raise TypeError('a frozen arbor is read-only')
+        runs = self.lex_translate(rough).split()
+        sequence = self.lex_tokens(runs)
+        intern = self.vocabulary.intern
+        letters = intern(self.generate_acronym(sequence))
+        existing = self.acro.get(letters, set())
+
+        # Build the join table of tokens run together,
+        # counting the names making each entry.
+        if self.control['joins'] and rough not in existing:
+            joined = self.join_counts()
+            for pair in self.generate_joins(runs):
+                self.joins.setdefault(pair[0], set()).add(pair[1])
+                joined[pair] = joined.get(pair, 0) + 1
 
         # Build the acronym dictionary.
-        letters = self.generate_acronym(sequence)
-        existing = self.acro.get(letters, set())
         existing.add(rough)
         self.acro[letters] = existing
 
         # Build the word arbor.
+        self.invalidate()
         height, branch = 0, self.root
 
         branch[u'#'] = 0
-        for word in sequence:
+        for token in [intern(word) for word in sequence]:
             height += 1
-            branch[word] = branch.get(word, {})
-            branch = branch[word]
+            if token not in branch:
+                branch[token] = Branch()
+                self.index_child(branch, token)
+            branch = branch[token]
             branch[u'#'] = height
         if not branch.get('.'):
-            branch['.'] = rough
-            branch['.soundex4'] = self.soundex4(rough)
-            branch['.dmeta'] = self.dmeta(rough)
-            #branch['.nyssis'] = fuzzy.nyssis(rough)
+            self.name_branch(branch, rough)
+
+    def name_branch(self, branch, rough):
+        # Make rough the canonical name of the branch its tokens reach.
+        branch['.'] = rough
+        branch['.soundex4'] = self.soundex4(self.ascii(rough))
+        branch['.dmeta'] = self.dmeta(self.ascii(rough))
+        #branch['.nyssis'] = fuzzy.nyssis(rough)
+
+    def add_canonical(self, canonical, variants=()):
+        # Add a canonical name, and make it and its known variants aliases.
+        # A frozen or loaded dictionary is thawed first.
+        self.thaw()
+        self.fill_arbor(canonical)
+        for variant in (canonical,) + tuple(variants):
+            self.add_alias(variant, canonical)
+        self.boards[canonical] = set(variants)
+
+    def remove_canonical(self, canonical):
+        # Remove a canonical name, its acronym entry and its aliases.
+        # Its branches are pruned back to where another name shares them,
+        # with their secondary indexes.  If another name lexes the same,
+        # it names the branch instead.  Return whether it was there.
+        # A byte str or unicode name removes the one stored decoding the
+        # same.  A frozen or loaded dictionary is thawed first.
+        self.thaw()
+        joined = self.join_counts()
+        sequence = self.lex_line(canonical)
+        found = False
+        letters = self.vocabulary.get(self.generate_acronym(sequence))
+        named = self.acro.get(letters)
+        for name in named or ():
+            if collation(name) == collation(canonical):
+                canonical = name
+                break
+        if named and canonical in named:
+            found = True
+            named.discard(canonical)
+            if not named:
+                del self.acro[letters]
+            # Join entries no other name makes are removed.
+            for pair in self.generate_joins(
+                    self.lex_translate(canonical).split()):
+                count = joined.pop(pair, 0) - 1
+                if count > 0:
+                    joined[pair] = count
+                elif pair[1] in self.joins.get(pair[0], ()):
+                    self.joins[pair[0]].discard(pair[1])
+                    if not self.joins[pair[0]]:
+                        del self.joins[pair[0]]
+        for key in self.alias_keys().pop(canonical, ()):
+            names = self.aliases.get(key)
+            if names and canonical in names:
+                found = True
+                names.discard(canonical)
+                if not names:
+                    del self.aliases[key]
+        self.boards.pop(canonical, None)
+
+        path, branch = [], self.root
+        for word in sequence:
+            token = self.vocabulary.get(word)
+            if token not in branch:
+                break
+            path.append((branch, token))
+            branch = branch[token]
+        else:
+            if collation(branch.get('.')) == collation(canonical):
+                found = True
+                for key in Branch.metadata[1:]:
+                    branch.pop(key, None)
+                same = sorted([name for name in named or ()
+                    if self.lex_line(name) == sequence], key=collation)
+                if same:
+                    self.name_branch(branch, same[0])
+            while path and not branch.children() and '.' not in branch:
+                parent, token = path.pop()
+                del parent[token]
+                self.unindex_child(parent, token)
+                branch = parent
+        self.invalidate()
+        return found
+
+    def update_from_csv(self, path):
+        # Bring the dictionary up to date with a changed boards.csv file.
+        # Only the differences from the lines last added are applied,
+        # and the (added, removed, changed) canonical names are counted.
+        # The differences are all found before any is applied.
+        items = dict([(item[0], set(item[1:])) for item in read_boards(path)])
+        removed = [canonical for canonical, variants in self.boards.items()
+                if canonical not in items]
+        updated = [(canonical, self.boards.get(canonical), variants)
+                for canonical, variants in items.iteritems()
+                if self.boards.get(canonical) != variants]
+        for canonical in removed:
+            self.remove_canonical(canonical)
+        for canonical, old, variants in updated:
+            self.add_canonical(canonical, variants)
+            # A dropped variant lexing as a kept one keeps their alias.
+            kept = set([self.alias_key(variant)
+                for variant in (canonical,) + tuple(variants)])
+            for variant in (old or set()) - variants:
+                if self.alias_key(variant) not in kept:
+                    self.remove_alias(variant, canonical)
+        added = len([old for canonical, old, variants in updated
+            if old is None])
+        return added, len(removed), len(updated) - added
+
+    def thaw(self):
+        # Make a frozen or loaded dictionary changeable again, as Branch
+        # dicts and dicts.  Token ids are kept.  This costs about as much
+        # as filling it, and is done once.
+        if isinstance(self.root, FrozenBranch):
+            frozen = self.vocabulary
+            self.vocabulary = Vocabulary(self.generate_index_keys)
+            for i, token in enumerate(frozen.tokens):
+                self.vocabulary.intern(token)
+                self.vocabulary.features[i] = frozen.features[i]
+            self.root = self.thaw_branch(self.root)
+            self.acro = dict(self.acro.items())
+            self.joins = dict(self.joins.items())
+            self.aliases = dict(self.aliases.items())
+            self.boards = dict(self.boards.items())
+            self.invalidate()
+        return self
+
+    def thaw_branch(self, frozen):
+        # Make a Branch of a FrozenBranch, and of its children.
+        branch = Branch()
+        for key in Branch.metadata:
+            value = frozen.get(key)
+            if value is not None:
+                branch[key] = value
+        for token in frozen.children():
+            branch[token] = self.thaw_branch(frozen[token])
+            self.index_child(branch, token)
+        return branch
+
+    def add_alias(self, variant, canonical):
+        # Make a known variant of a canonical name resolve in one lookup.
+        # Variants are keyed by their lexed tokens, so every input lexing
+        # the same resolves with them.  A variant of several canonical
+        # names resolves to the set of them, as an ambiguous acronym does.
+        if not isinstance(self.aliases, dict):
+            raise TypeError('a loaded alias table is read-only')
+        key = self.alias_key(variant)
+        if key:
+            self.aliases.setdefault(key, set()).add(canonical)
+            self.alias_keys().setdefault(canonical, set()).add(key)
+
+    def remove_alias(self, variant, canonical):
+        # Forget that a variant is known for a canonical name.
+        if not isinstance(self.aliases, dict):
+            raise TypeError('a loaded alias table is read-only')
+        key = self.alias_key(variant)
+        names = self.aliases.get(key)
+        if names and canonical in names:
+            names.discard(canonical)
+            if not names:
+                del self.aliases[key]
+        keys = self.alias_keys().get(canonical)
+        if keys and key in keys:
+            keys.discard(key)
+            if not keys:
+                del self.aliased[canonical]
+
+    def join_counts(self):
+        # The number of names making each (key, run) entry of the join
+        # table, so that removing a name removes only the entries no other
+        # name makes.  It is made from the names of the acronym table when
+        # first needed, once after loading an index.
+        if self.joined is None:
+            self.joined = dict()
+            for letters, names in self.acro.items():
+                for name in names:
+                    for pair in self.generate_joins(
+                            self.lex_translate(name).split()):
+                        self.joined[pair] = self.joined.get(pair, 0) + 1
+        return self.joined
+
+    def alias_key(self, variant):
+        # The key of a variant in the alias table, its lexed tokens.
+        return string.join(self.lex_line(variant), ' ')
+
+    def alias_keys(self):
+        # The alias keys of each canonical name, so that removing a name
+        # looks up only its own aliases.  It is made from the alias table
+        # when first needed, once after loading an index.
+        if self.aliased is None:
+            self.aliased = dict()
+            for key, names in self.aliases.items():
+                for name in names:
+                    self.aliased.setdefault(name, set()).add(key)
+        return self.aliased
+
+    def fill_board(self, item):
+        # Fill the arbor with the canonical name of a boards.csv line,
+        # and make it and every known variant on the line its aliases.
+        self.add_canonical(item[0], item[1:])
+
+    def absorb(self, path):
+        # Make the matches of a good csv file aliases of their canonical
+        # names, so they resolve in one lookup from now on.
+        # Ambiguous acronym matches, written as set(...), are left out.
+        for item in read_boards(path, discard=()):
+            if len(item) == 2 and not item[0].startswith('set('):
+                self.add_alias(item[1], item[0])
+
+    def freeze(self):
+        # Compile the arbor into its compact read-only form.
+        # The dict arbor is released and search runs against the frozen one.
+        # Tokens are renumbered in order, in the arbor and the acronyms.
+        if not isinstance(self.root, FrozenBranch):
+            vocabulary, remap = self.vocabulary.sorted()
+            self.root = FrozenArbor(self.root, vocabulary, remap).root()
+            self.acro = dict([(remap[token], names)
+                for token, names in self.acro.iteritems()])
+            self.vocabulary = vocabulary
+            self.invalidate()
+        return self
+
+    def save_index(self, path):
+        # Save the vocabulary, the frozen arbor, and the acronym, join,
+        # alias and boards tables as an index file.
+        # The arbor is frozen first if it is not already.
+        self.freeze()
+        acronyms = sorted(self.acro)
+        offsets, values = [0], []
+        for token in acronyms:
+            values.extend(sorted(self.acro[token], key=collation))
+            offsets.append(len(values))
+        sections = IndexFile.pack_strings('tokens', self.vocabulary.tokens)
+        sections += self.root.arbor.sections()
+        sections.append(('acro.ids', IndexFile.pack_ints(acronyms)))
+        sections.append(('acro.offsets', IndexFile.pack_ints(offsets)))
+        sections += IndexFile.pack_strings('acro.values', values)
+        sections += IndexFile.pack_sets('joins', self.joins)
+        sections += IndexFile.pack_sets('aliases', self.aliases)
+        sections += IndexFile.pack_sets('boards', self.boards)
+        IndexFile.write(path, sections)
+
+    def load_index(self, path):
+        # Replace the vocabulary, arbor, and acronym, join, alias and boards
+        # tables with a memory-mapped index file.
+        # Nothing is rebuilt, and the pages are shared between processes.
+        index = IndexFile(path)
+        self.vocabulary = Vocabulary.mapped(
+                index.strings('tokens'), self.generate_index_keys)
+        self.root = FrozenArbor.mapped(index).root()
+        self.acro = MappedAcronyms(
+                index.ints('acro.ids'),
+                index.ints('acro.offsets'),
+                index.strings('acro.values'))
+        self.joins = index.sets('joins')
+        self.joined = None
+        self.aliases = index.sets('aliases')
+        self.aliased = None
+        self.boards = index.sets('boards')
+        self.invalidate()
+        return self
+
+    def expand(self, branch=None):
+        # Make plain nested dicts keyed by tokens of (a branch of) the arbor,
+        # for inspection.
+        branch = self.root if branch is None else branch
+        tokens = self.vocabulary.tokens
+        expanded = dict([(tokens[token], self.expand(branch[token]))
+            for token in branch.children()])
+        for key in Branch.metadata:
+            value = branch.get(key)
+            if value is not None:
+                expanded[key] = value
+        return expanded
+
+    def matching(self):
+        # The values of the controls changing what matches, which may be
+        # changed between calls, to key what is remembered of a call.
+        values = [self.control.get(name) for name in Similar.matching_controls]
+        return tuple([tuple(value) if isinstance(value, list) else value
+            for value in values])
+
+    def invalidate(self):
+        # Discard everything derived from self.root and self.acro.
+        # This must be called whenever either of them changes.
+        if self.cache is not None:
+            self.cache.clear()
+        if self.negative is not None:
+            self.negative.clear()
+        self.near.clear()
+        self.bloom = None
+
+    def rejects(self, tokens):
+        # Whether the first token can match no child of the root, so that
+        # the arbor need not be walked.  This asks the chosen algorithms'
+        # candidate finders of a Bloom filter over the root's children
+        # and their index keys, made when first needed.
+        if not self.control['bloom']:
+            return False
+        if self.bloom is None:
+            self.bloom = BloomBranch(self.root, self.vocabulary)
+        if tokens[0] in self.bloom:
+            return False
+        if self.control['joins']:
+            for step in self.generate_boundaries(self.root, tokens):
+                return False
+        word = self.vocabulary.word(tokens[0])
+        for letter in self.control.get('algorithms'):
+            finder = self.master_algorithm_list[letter].get('candidates')
+            if not finder:
+                return False
+            for canon in finder(self.bloom, word):
+                return False
+        return True
 
     def bool_algorithm_fat_finger(self, canon, rough):
         # Discover whether all the characters in a token are
         # within one key distance on the keyboard for a given canonical word.
-        N, Nc, Nr = 0, len(canon), len(rough)
-        if Nc != Nr:
+        if len(canon) != len(rough):
             return False
-        for n in range(Nc):
-            Cc, Cr = canon[n], rough[n]
-            if not self.fast_lookup[self.generate_fat_finger_index(Cr, Cc)]:
-                break
-            N += 1
-        message = 'fat finger [%d/%d] %s' % (N, Nc, str(N == Nc))
-        result = self.bool_report(N == Nc, message, rough, canon)
-        return result
+        return self.fingers.near(canon, rough)
+
+    def candidates_fat_finger(self, branch, word):
+        # Fat fingering never changes the length of a token.
+        return branch.lookup('lengths', [len(word)])
 
     def bool_algorithm_Levenshtein1(self, canon, rough):
         # Handle identity.
         if canon == rough:
-            return self.bool_report(True, 'Levenshtein1', rough, canon)
-        self.generate_head_tail_indices(canon, rough)
+            return True
+        ht = self.generate_head_tail_indices(canon, rough)
         # Handle length difference out-of-range.
-        if abs(self.Clen-self.Rlen) > 1:
+        if abs(ht.Clen-ht.Rlen) > 1:
             return False
         # Handle deletion and insertion.
-        if self.Clen != self.Rlen:
-            return self.Nmin == self.both
+        # Head and tail overlap when it is next to a repeated letter.
+        if ht.Clen != ht.Rlen:
+            return ht.both >= ht.Nmin
         # Handle a single typo.
-        if self.diff == 1:
-            return self.bool_report(True, 'Levenshtein1', rough, canon)
+        if ht.diff == 1:
+            return True
         # Handle 1 swapped pair.
-        diagonal1 = canon[   self.head] == rough[-1-self.tail]
-        diagonal2 = canon[-1-self.tail] == rough[   self.head]
-        if diagonal1 and diagonal2:
-            return self.bool_report(True, 'Levenshtein1', rough, canon)
-        return False
+        diagonal1 = canon[   ht.head] == rough[-1-ht.tail]
+        diagonal2 = canon[-1-ht.tail] == rough[   ht.head]
+        return diagonal1 and diagonal2
+
+    def bool_algorithm_Levenshtein(self, canon, rough):
+        # Handle up to generate_distance(rough) edits.
+        return self.generate_edits(canon, rough) is not None
 
     def bool_algorithm_Lettvin(self, canon, rough, level=0):
         if not rough:
@@ -432,31 +1938,128 @@ class Similar(dict):
     def bool_algorithm_contraction(self, canon, rough):
         # Handle identity.
         if canon == rough:
-            return self.bool_report(True, 'contraction', rough, canon)
-        self.generate_head_tail_indices(canon, rough)
+            return True
+        ht = self.generate_head_tail_indices(canon, rough)
         rlen = len(rough)
         less = rlen - 2
-        if rlen == self.head:
-            return self.bool_report(True, 'contraction', rough, canon)
-        if self.head >= 2:
-            return self.bool_report(True, 'contraction', rough, canon)
-        if self.both > less:
-            return self.bool_report(True, 'contraction', rough, canon)
-        return False
+        if rlen == ht.head:
+            return True
+        if ht.head >= 2:
+            return True
+        return ht.both > less
+
+    def bool_algorithm_phonetic(self, letter, canon, rough):
+        # Two tokens match when they share a phonetic code.
+        codes = self.generate_phonetic(letter, canon)
+        return bool(codes & self.generate_phonetic(letter, rough))
+
+    def candidates_contraction(self, branch, word):
+        # A contraction of two or more letters shares
+        # either its first or its last letter with the canonical token.
+        # Shorter ones are accepted against any token.
+        if len(word) < 2:
+            return branch.children()
+        return itertools.chain(
+                branch.lookup('leads', [word[:1]]),
+                branch.lookup('tails', [word[-1:]]))
 
     def bool_algorithm_soundex(self, canon, rough):
-        return False
+        return self.bool_algorithm_phonetic('s', canon, rough)
 
     def bool_algorithm_metaphone(self, canon, rough):
-        return False
+        return self.bool_algorithm_phonetic('m', canon, rough)
 
     def bool_algorithm_NYSSIS(self, canon, rough):
-        return False
+        return self.bool_algorithm_phonetic('N', canon, rough)
+
+    def candidates_soundex(self, branch, word):
+        # Children sounding alike are found in the phonetic bucket.
+        return branch.lookup('soundex', self.generate_phonetic('s', word))
+
+    def candidates_metaphone(self, branch, word):
+        return branch.lookup('metaphone', self.generate_phonetic('m', word))
+
+    def candidates_NYSSIS(self, branch, word):
+        return branch.lookup('NYSSIS', self.generate_phonetic('N', word))
 
     def bool_algorithm_exact(self, canon, rough):
-        return self.bool_report(canon == rough, 'exact', rough, canon)
+        return canon == rough
+
+    def candidates_exact(self, branch, word):
+        # Only the identical child can match exactly.
+        token = self.vocabulary.get(word)
+        if token is not None and token in branch:
+            return [token]
+        return []
+
+    def candidates_Levenshtein1(self, branch, word):
+        # Children within distance 1 share a single-deletion variant.
+        return branch.lookup('deletes', self.generate_deletes(word))
+
+    def candidates_Levenshtein(self, branch, word):
+        # The children among the near tokens, fewest edits first.
+        near = self.generate_near(word)
+        return sorted([token for token in near if token in branch],
+                key=near.get)
+
+    def cost_exact(self, canon, rough):
+        return 1.0 if canon == rough else None
+
+    def cost_fat_finger(self, canon, rough):
+        # Each key struck next to the intended one costs a factor.
+        if len(canon) != len(rough):
+            return None
+        misses = self.fingers.misses(canon, rough)
+        if misses is None:
+            return None
+        return self.costs['f'] ** misses
+
+    def cost_Levenshtein1(self, canon, rough):
+        if canon == rough:
+            return 1.0
+        if self.bool_algorithm_Levenshtein1(canon, rough):
+            return self.costs['L']
+        return None
+
+    def cost_Levenshtein(self, canon, rough):
+        # Each edit costs a factor.
+        edits = self.generate_edits(canon, rough)
+        if edits is None:
+            return None
+        return self.costs['K'] ** edits
+
+    def cost_contraction(self, canon, rough):
+        # The more letters a contraction leaves out, the more it costs,
+        # and letters not found in order in the canonical token cost again.
+        if canon == rough:
+            return 1.0
+        if not self.bool_algorithm_contraction(canon, rough):
+            return None
+        longer = max(len(canon), len(rough))
+        factor = self.costs['c'] * (
+                1.0 + abs(len(canon) - len(rough)) / float(longer))
+        letters = iter(canon)
+        if not all(c in letters for c in rough if c not in "'-"):
+            factor *= self.costs['c']
+        return factor
+
+    def cost_phonetic(self, letter, canon, rough):
+        if canon == rough:
+            return 1.0
+        if self.bool_algorithm_phonetic(letter, canon, rough):
+            return self.costs[letter]
+        return None
+
+    def cost_soundex(self, canon, rough):
+        return self.cost_phonetic('s', canon, rough)
+
+    def cost_metaphone(self, canon, rough):
+        return self.cost_phonetic('m', canon, rough)
 
-    def bool_recurse(self, branch, sequence, **kw):
+    def cost_NYSSIS(self, canon, rough):
+        return self.cost_phonetic('N', canon, rough)
+
+    def bool_recurse(self, branch, sequence, context=None, **kw):
         # This function does the heavy lifting for
         # Determining the type of match a token has
         # at a given branch of dictionary.
@@ -464,41 +2067,69 @@ class Similar(dict):
         # until either a match is found, or none can be.
         # So if a recursion terminates in a failure,
         # and a branch is not exhausted, the search continues.
+        # The algorithm used at each level is noted in the per-call context,
+        # and each match is traced when the call is.
+        if context is None:
+            context = Context()
 
-        if not isinstance(branch, dict):
+        if not isinstance(branch, (dict, FrozenBranch)):
             # No dictionary, so stop with no results.
             return False, [], ''
         if not len(sequence):
             # Tokens finished, so return the canonical form.
             return True, [], branch.get('.', '')
 
-        # Get the first word.
-        word = sequence[0]
+        # Get the first token (its id if it is in the vocabulary).
+        token = sequence[0]
+        word = self.vocabulary.word(token)
         current_algorithm = '?'
         level = branch['#']
 
         separate = True
-        if separate and branch.get(word):
+        if separate and branch.get(token):
             # If it has an exact match, recurse.
             flag, result, final = self.bool_recurse(
-                branch[word], sequence[1:], **kw)
+                branch[token], sequence[1:], context, **kw)
             if not final:
                 # If recursion failed to make canonical
                 # Perhaps it is canonical at this branch.
                 final = branch.get('.', '')
             if final:
-                self.using[level] = '.'
+                context.using[level] = '.'
                 # If canonical form was found, then report it.
                 flag = True
+                if context.trace:
+                    context.trace.emit({'event': 'match', 'level': level,
+                        'algorithm': '.', 'rough': word, 'canon': word})
             return flag, [word].append(result), final
 
-        # If no exact match is found, try fuzziness.
-        for canon, val in branch.iteritems():
+        # Then try exact matches across a word boundary lost or added.
+        if self.control['joins']:
+            for letter, canon, child, rest, crossed in (
+                    self.generate_boundaries(branch, sequence)):
+                flag, result, final = self.bool_recurse(
+                    child, rest, context, **kw)
+                if final:
+                    for n in range(crossed):
+                        context.using[level + n] = letter
+                    if context.trace:
+                        context.trace.emit({'event': 'match',
+                            'level': level, 'algorithm': letter,
+                            'rough': word, 'canon': canon})
+                    return True, [word], final
+
+        # If no exact match is found, try fuzziness,
+        # but only on children that some algorithm could match.
+        candidates = self.generate_candidates(branch, word)
+        if self.statistics is not None:
+            self.statistics.scan(level, len(candidates))
+        tokens = self.vocabulary.tokens
+        for canon in candidates:
             found = False
             for letter in self.control.get('algorithms'):
                 current_algorithm = letter
                 algorithm = self.master_algorithm_list[letter]['algorithm']
-                found |= algorithm(canon, word)
+                found |= algorithm(tokens[canon], word)
                 if found:
                     # For optimization, take the first match.
                     # If a combined measure is wanted, remove this break.
@@ -506,10 +2137,14 @@ class Similar(dict):
             result, final = [], ''
 
             if found:
-                self.using[level] = current_algorithm
+                context.using[level] = current_algorithm
+                if context.trace:
+                    context.trace.emit({'event': 'match', 'level': level,
+                        'algorithm': current_algorithm,
+                        'rough': word, 'canon': tokens[canon]})
                 # As with the exact match, report recursed or current match.
                 flag, result, final = self.bool_recurse(
-                    branch[canon], sequence[1:], **kw)
+                    branch[canon], sequence[1:], context, **kw)
                 if not final:
                     final = branch.get('.', '')
                 if final:
@@ -537,7 +2172,8 @@ class Similar(dict):
             # this loop enables sequential re-lookup on a prior search
             # because white-list non-canonicals are permitted to
             # populate the dictionary and return canonicals.
-            mBool, result, canon = self.bool_recurse(self.root, sequence, **kw)
+            mBool, result, canon = self.bool_recurse(
+                    self.root, self.vocabulary.encode(sequence), **kw)
             if not canon:
                 break
             if previous == canon:
@@ -545,6 +2181,108 @@ class Similar(dict):
             previous = canon
         return mBool, result, canon
 
+    def rank(self, rough, k=5):
+        # Return the k best (score, canonical, used) answers for a rough
+        # input, least score first.  k of None returns every answer.
+        return self.search(self.lex_line(rough), k)
+
+    def search(self, sequence, k=5):
+        # A scored, branch-and-bound search for a lexed token sequence.
+        # The arbor is walked cheapest match first, and a branch is pruned
+        # as soon as its product of costs reaches the k-th best score found.
+        # Alias and then acronym answers are added, unless already found.
+        best = []
+        if sequence and sequence[0]:
+            self.search_branch(self.root, self.vocabulary.encode(sequence),
+                    1.0, '', best, k)
+            found = set([canonical for score, order, canonical, used
+                in best])
+            names = self.aliases.get(string.join(sequence, ' ')) or ()
+            for canonical in sorted(names, key=collation):
+                if canonical not in found:
+                    found.add(canonical)
+                    self.search_offer(
+                            best, k, -self.costs['='], canonical, '=')
+            for acronym in [string.join(sequence, ''), sequence[0]]:
+                names = self.acro.get(self.vocabulary.get(acronym)) or ()
+                for canonical in sorted(names, key=collation):
+                    if canonical not in found:
+                        found.add(canonical)
+                        self.search_offer(
+                                best, k, -self.costs['A'], canonical, 'A')
+        return [(-score, canonical, used) for score, order, canonical, used
+                in sorted(best, key=lambda entry: (-entry[0], entry[1]))]
+
+    def search_offer(self, best, k, score, canonical, used):
+        # Keep an answer among the k best, a heap of negated scores.
+        # Equal scores are ordered by the collation of the names,
+        # so that byte str and unicode names are never compared.
+        order = (collation(canonical), used, isinstance(canonical, unicode))
+        if k is None or len(best) < k:
+            heapq.heappush(best, (score, order, canonical, used))
+        elif score > best[0][0]:
+            heapq.heapreplace(best, (score, order, canonical, used))
+
+    def search_branch(self, branch, sequence, cost, used, best, k):
+        # Offer the canonical of a branch, scored with the tokens left over,
+        # and search its children matching the next token.
+        # Each algorithm scores only the children its finder offers,
+        # and none is tried that cannot beat the k-th best score.
+        full = k is not None and len(best) >= k
+        if full and cost >= -best[0][0]:
+            return
+        canonical = branch.get('.')
+        if canonical:
+            self.search_offer(best, k,
+                    -cost * self.costs['-'] ** len(sequence), canonical, used)
+            full = k is not None and len(best) >= k
+        if not sequence:
+            return
+        limit = -best[0][0] / cost if full else float('inf')
+        token = sequence[0]
+        word = self.vocabulary.word(token)
+        tokens = self.vocabulary.tokens
+        factors, scanned = {}, 0
+        if branch.get(token):
+            factors[token] = (1.0, '.')
+        for letter in self.control.get('algorithms'):
+            entry = self.master_algorithm_list[letter]
+            score = entry.get('cost')
+            if not score or self.costs.get(letter, 1.0) >= limit:
+                continue
+            finder = entry.get('candidates')
+            for canon in finder(branch, word) if finder else branch.children():
+                scanned += 1
+                if canon == token:
+                    continue
+                factor = score(tokens[canon], word)
+                if factor is not None and factor < factors.get(
+                        canon, (limit,))[0]:
+                    factors[canon] = (factor, letter)
+        if self.statistics is not None:
+            self.statistics.scan(branch['#'], scanned)
+        # A step is (factor, letters, child token id, child, tokens left).
+        # Steps across a word boundary have their branch already, and
+        # negative ids, so sorting never compares branches.
+        steps = [(factor, letter, child, None, sequence[1:])
+            for child, (factor, letter) in factors.iteritems()]
+        if self.control['joins']:
+            for n, (letter, canon, child, rest, crossed) in enumerate(
+                    self.generate_boundaries(branch, sequence)):
+                factor = self.costs[letter] ** max(1, crossed - 1)
+                if factor < limit:
+                    steps.append(
+                            (factor, letter * crossed, -1 - n, child, rest))
+        for factor, letters, key, child, rest in sorted(steps):
+            if k is not None and len(best) >= k and (
+                    cost * factor >= -best[0][0]):
+                # Steps are cheapest first, so no later one can do better.
+                break
+            if child is None:
+                child = branch[key]
+            self.search_branch(child, rest,
+                    cost * factor, used + letters, best, k)
+
     def __init__(self, canon = {ABIM: ['ABIM']}, **kw):
         # Setup parameters for execution.
         self.control = {
@@ -555,48 +2293,97 @@ class Similar(dict):
                 'left'      : 2,
                 'right'     : 2,
                 'verbose'   : True,
-                'output'    : None
+                'output'    : None,
+                'cache'     : 0,
+                'statistics': False,
+                'sample'    : 1,
+                'joins'     : 0,
+                'negative'  : 10000,
+                'bloom'     : False
                 }
         self.control.update(kw)
         self.good = self.control.get('good', None)
         self.fail = self.control.get('fail', None)
-        self.log = self.control.get('output', None)
+        # Optional trace of matches to the output stream, one call in sample.
+        log = self.control.get('output', None)
+        self.trace = Tracer(log, self.control['sample']) if log else None
         self.acronyms = self.control.get('acronym', True)
         self.contraction = self.control.get('contraction', True)
         self.soundex4 = fuzzy.Soundex(4)
         self.dmeta = fuzzy.DMetaphone()
-        self.transforms = '' # Must precede self.lex, but follow self.log
 
         self.master_algorithm_list = {
                 '_': {'algorithm': self.bool_algorithm_Lettvin, },
-                'c': {'algorithm': self.bool_algorithm_contraction, },
-                'e': {'algorithm': self.bool_algorithm_exact, },
-                'f': {'algorithm': self.bool_algorithm_fat_finger,},
-                'L': {'algorithm': self.bool_algorithm_Levenshtein1,},
-                'm': {'algorithm': self.bool_algorithm_metaphone,},
-                'N': {'algorithm': self.bool_algorithm_NYSSIS,},
-                's': {'algorithm': self.bool_algorithm_soundex},
+                'c': {'algorithm': self.bool_algorithm_contraction,
+                      'candidates': self.candidates_contraction,
+                      'cost': self.cost_contraction, },
+                'e': {'algorithm': self.bool_algorithm_exact,
+                      'candidates': self.candidates_exact,
+                      'cost': self.cost_exact, },
+                'f': {'algorithm': self.bool_algorithm_fat_finger,
+                      'candidates': self.candidates_fat_finger,
+                      'cost': self.cost_fat_finger, },
+                'K': {'algorithm': self.bool_algorithm_Levenshtein,
+                      'candidates': self.candidates_Levenshtein,
+                      'cost': self.cost_Levenshtein, },
+                'L': {'algorithm': self.bool_algorithm_Levenshtein1,
+                      'candidates': self.candidates_Levenshtein1,
+                      'cost': self.cost_Levenshtein1, },
+                'm': {'algorithm': self.bool_algorithm_metaphone,
+                      'candidates': self.candidates_metaphone,
+                      'cost': self.cost_metaphone, },
+                'N': {'algorithm': self.bool_algorithm_NYSSIS,
+                      'candidates': self.candidates_NYSSIS,
+                      'cost': self.cost_NYSSIS, },
+                's': {'algorithm': self.bool_algorithm_soundex,
+                      'candidates': self.candidates_soundex,
+                      'cost': self.cost_soundex, },
         }
 
+        # Optional profiling counters.
+        self.statistics = None
+        if self.control['statistics']:
+            self.enable_statistics()
+
         # Extract parameters.
         self.stopwords = self.control['stopwords']
+        # One keyboard layout, or several, comma separated or in a list.
         keyboard_layout = self.control['keyboard']
-        self.keyboard = Similar.keyboard[keyboard_layout]
+        if isinstance(keyboard_layout, basestring):
+            keyboard_layout = keyboard_layout.split(',')
+        self.keyboards = tuple(keyboard_layout)
 
-        self.root = dict()
+        self.vocabulary = Vocabulary(self.generate_index_keys)
+        self.root = Branch()
         self.acro = dict()
-
-        # Convert fatfinger lists to fast lookup table.
-        self.fast_lookup = [False]*65536
-        for intended, neighbors in self.keyboard.iteritems():
-            for neighbor in neighbors:
-                # At this point, characters are known to be 0-255
-                self.fast_lookup[
-                        self.generate_fat_finger_index(neighbor, intended)
-                        ] = True
-        N = 0
-        for n in range(65536):
-            N += int(self.fast_lookup[n])
+        # Runs of tokens by their words run together,
+        # and the names making each, counted when first needed.
+        self.joins = dict()
+        self.joined = None
+        # Known variants of canonical names, by their lexed tokens,
+        # and the keys of each canonical name's, made when first needed.
+        self.aliases = dict()
+        self.aliased = None
+        # The known variants of each canonical name added from boards.csv.
+        self.boards = dict()
+
+        # Optional LRU cache of resolved token sequences (0 disables it).
+        cache_size = self.control['cache']
+        self.cache = LRU(cache_size) if cache_size else None
+        # Tokens within edit distance of recent query tokens, for 'K'.
+        self.near = LRU(4096)
+        # LRU cache of sequences that failed (0 disables it),
+        # and the optional Bloom prefilter of the root, made when needed.
+        negative = self.control['negative']
+        self.negative = LRU(negative) if negative else None
+        self.bloom = None
+
+        # The fat finger tables of the layouts, shared with other instances.
+        # fast_lookup is indexed by generate_fat_finger_index.
+        self.fingers = Keyboard.compile(self.keyboards,
+                [Similar.keyboard[name] for name in self.keyboards])
+        self.keyboard = self.fingers.neighbors
+        self.fast_lookup = self.fingers.table
 
         # Convert canonical list to all uppercase.
         for key, vals in canon.iteritems():
@@ -604,61 +2391,587 @@ class Similar(dict):
             VALS = [val for val in VALS if val not in self.stopwords]
             self[key.upper()] = self.get(key.upper(), []).append(VALS)
 
-    def __call__(self, rough, **kw):
-        self.transforms = '' # Must precede self.lex
-        self.using = {}
-        letters, matchBool, result, canonical = False, False, [], ''
-        sequence = self.lex_line(rough)
+    def enable_statistics(self, enable=True):
+        # Start (or stop) counting algorithm calls, hits and time,
+        # children scanned per level, and how calls were answered.
+        # Algorithms are wrapped only while counting,
+        # so that counting costs nothing in the matching loop otherwise.
+        for entry in self.master_algorithm_list.itervalues():
+            entry['algorithm'] = getattr(
+                    entry['algorithm'], 'algorithm', entry['algorithm'])
+        self.statistics = Statistics() if enable else None
+        if enable:
+            for letter, entry in self.master_algorithm_list.iteritems():
+                entry['algorithm'] = self.statistics.timed(
+                        letter, entry['algorithm'])
+
+    def stats(self):
+        # Return a snapshot of the profiling counters, or None if disabled.
+        if self.statistics is None:
+            return None
+        return self.statistics.snapshot()
+
+    def close(self):
+        # Finish writing the trace.  Call this before closing its stream.
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def context(self):
+        # Make the Context of a new call, traced if it is sampled.
+        if self.trace is not None and self.trace.sampled():
+            return Context(self.trace)
+        return Context()
+
+    def resolve(self, sequence, context=None, **kw):
+        # Find the canonical form for an already lexed token sequence.
+        # Everything here depends only on the tokens, so the result
+        # may be shared by every rough input lexing to the same sequence.
+        # All per-call state lives in a Context, so one instance may
+        # serve concurrent calls from many threads.
+        if context is None:
+            context = self.context()
+        matchBool, result, canonical = False, [], ''
+
+        answer = 'none'
+
+        # A known variant resolves in one lookup, before anything else.
+        names = self.aliases.get(string.join(sequence, ' '))
+        if names:
+            if self.statistics is not None:
+                self.statistics.answer('alias')
+            canonical = list(names)[0] if len(names) == 1 else names
+            return True, canonical, '='
+
+        # Results, and sequences known to fail, are remembered
+        # under the controls then chosen.
+        key = (self.matching(), tuple(sequence))
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached:
+                if self.statistics is not None:
+                    self.statistics.answer('cache')
+                return cached
+
+        if self.negative is not None and self.negative.get(key):
+            if self.statistics is not None:
+                self.statistics.answer('negative')
+            return False, '', ''
 
         if sequence and sequence[0]:
-            if not self.acronyms:
-                matchBool, result, canonical = self.bool_recurse(
-                    self.root, sequence, **kw)
-            else:
+            tokens = self.vocabulary.encode(sequence)
+            if self.acronyms:
                 acronyms = [string.join(sequence, ''), sequence[0]]
                 for acronym in acronyms:
-                    if self.acro.get(acronym):
-                        letters = True
+                    names = self.acro.get(self.vocabulary.get(acronym))
+                    if names:
                         matchBool = True
-                        canonical = self.acro[acronym]
+                        canonical = names
+                        answer = 'acronym'
                         break
-                if not matchBool:
+            if not matchBool:
+                if self.rejects(tokens):
+                    answer = 'rejected'
+                else:
                     # A bug forces this back out of the loop until it is fixed.
                     matchBool, result, canonical = self.bool_recurse(
-                        self.root, sequence, **kw)
+                        self.root, tokens, context, **kw)
                     #self.loop(sequence)
-        if matchBool and canonical:
-            # The output to good csv file has two forms:
-            # 1. set(...) means acronym with possible ambiguity.
-            # 2. "words..." in column 1 means canonical name found.
-            if self.good:
-                print>>self.good, '"%s", "%s"' % (canonical, rough)
-        else:
-            # Output to fail csv file are uncanonicalized inputs.
-            if self.fail:
-                print>>self.fail, '"%s"' % (rough)
-        self.bool_report(
-                True, '1' if matchBool else '0',
-                #str(matchBool),
-                canonical,
-                rough,
-                tabs=0)
+                    answer = 'trie'
+        if not (matchBool and canonical):
+            if answer != 'rejected':
+                answer = 'none'
+            if self.negative is not None:
+                self.negative[key] = True
+        if self.statistics is not None:
+            self.statistics.answer(answer)
 
         # Build up the matching algorithm string from entries.
         used = ''
         for i in range(30):
-            c = self.using.get(i, '')
+            c = context.using.get(i, '')
             used += c
             if not c:
                 break
 
-        self.bool_report(True, None, 'canonical', canonical, used=used)
+        if self.cache is not None:
+            self.cache[key] = (matchBool, canonical, used)
 
         # If matchBool is True,
         # the dictionary arbor was walked to a proper terminal.
         # If it is True, canonical will have the matching canonical form.
         return matchBool, canonical, used
 
+    def record(self, rough, matchBool, canonical):
+        # Generate the line for the good or fail csv file.
+        # The output to good csv file has two forms:
+        # 1. set(...) means acronym with possible ambiguity.
+        # 2. "words..." in column 1 means canonical name found.
+        # Output to fail csv file are uncanonicalized inputs.
+        # Lines are UTF-8, whatever mix of names they are made from.
+        if isinstance(rough, unicode):
+            rough = rough.encode('utf-8')
+        if matchBool and canonical:
+            if isinstance(canonical, unicode):
+                canonical = canonical.encode('utf-8')
+            return self.good, '"%s", "%s"\n' % (canonical, rough)
+        return self.fail, '"%s"\n' % (rough)
+
+    def report(self, context, rough, matchBool, canonical, used):
+        # Trace the result of a call, if the call is traced.
+        if context.trace:
+            if isinstance(canonical, (set, frozenset)):
+                canonical = sorted(canonical)
+            context.trace.emit({'event': 'call', 'rough': rough,
+                'match': bool(matchBool), 'canonical': canonical,
+                'used': used})
+
+    def __call__(self, rough, **kw):
+        sequence = self.lex_line(rough)
+        context = self.context()
+        matchBool, canonical, used = self.resolve(sequence, context, **kw)
+
+        stream, line = self.record(rough, matchBool, canonical)
+        if stream:
+            stream.write(line)
+        self.report(context, rough, matchBool, canonical, used)
+
+        return matchBool, canonical, used
+
+    def resolve_many(self, roughs, **kw):
+        # Resolve a list of rough inputs in order.
+        # Each input is lexed once, and inputs lexing to the same sequence
+        # are resolved together through the acronyms and the arbor.
+        keys = [tuple(tokens) for tokens in self.lex_many(roughs)]
+        unique = dict.fromkeys(keys)
+        for key in unique:
+            context = self.context()
+            matchBool, canonical, used = self.resolve(list(key), context, **kw)
+            self.report(context, list(key), matchBool, canonical, used)
+            unique[key] = (matchBool, canonical, used)
+        return [unique[key] for key in keys]
+
+    def record_many(self, roughs, results):
+        # Write the good/fail lines of resolved inputs in one block per stream.
+        lines = {self.good: [], self.fail: []}
+        for rough, (matchBool, canonical, used) in zip(roughs, results):
+            stream, line = self.record(rough, matchBool, canonical)
+            if stream:
+                lines[stream].append(line)
+        for stream, block in lines.iteritems():
+            if stream and block:
+                stream.writelines(block)
+
+    def canonicalize_many(self, iterable, **kw):
+        # Canonicalize many rough inputs at once.
+        # The (matchBool, canonical, used) results are fanned back out
+        # in input order.  Data-entry feeds are mostly repeats,
+        # so the per-call tracing is done once per unique sequence,
+        # and good/fail lines are written in one block per stream.
+        roughs = list(iterable)
+        results = self.resolve_many(roughs, **kw)
+        self.record_many(roughs, results)
+        return results
+
+    def canonicalize_parallel(self, iterable, jobs=None, chunk=10000):
+        # Generate the results of canonicalize_many in input order,
+        # resolving chunks of inputs in a pool of forked worker processes.
+        # The workers share this instance (and its arbor) copy-on-write,
+        # so it must be filled or loaded before this is called.
+        # Only the parent writes the good/fail files,
+        # and at most two chunks per worker are in flight at a time.
+        global shared
+        jobs = jobs or multiprocessing.cpu_count()
+        shared = self
+        pool = multiprocessing.Pool(jobs, initializer=initialize_worker)
+        pending = collections.deque()
+
+        def finish():
+            # Record and return the results of the oldest chunk.
+            roughs, results = pending.popleft()
+            results = results.get()
+            self.record_many(roughs, results)
+            return results
+
+        try:
+            for roughs in generate_chunks(iterable, chunk):
+                pending.append((roughs, pool.apply_async(
+                    resolve_chunk, (roughs,))))
+                while len(pending) >= 2 * jobs or (pending and
+                        pending[0][1].ready()):
+                    for result in finish():
+                        yield result
+            while pending:
+                for result in finish():
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            shared = None
+
+
+# The Similar instance used by canonicalize_parallel worker processes.
+shared = None
+
+
+def initialize_worker():
+    # Workers only resolve; the parent writes every output stream.
+    # The parent's Tracer thread does not survive the fork.
+    shared.trace, shared.good, shared.fail = None, None, None
+
+
+def resolve_chunk(roughs):
+    # Resolve one chunk of rough inputs in a worker process.
+    return shared.resolve_many(roughs)
+
+
+def open_stream(path, mode='r'):
+    # Open a named file, a gzip (.gz) or bzip2 (.bz2) compressed file,
+    # or stdin/stdout for '-'.  Plain files get a large buffer.
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, mode, 1 << 20)
+    return open(path, mode, 1 << 20)
+
+
+def collation(name):
+    # The unicode of a name, to sort byte str and unicode names together.
+    # Bytes are taken to be UTF-8 when they can be, else Latin-1.
+    if isinstance(name, str):
+        try:
+            return name.decode('utf-8')
+        except UnicodeDecodeError:
+            return name.decode('latin-1')
+    return name
+
+
+def read_boards(path, discard=(u'OTHER', u'IGNORE')):
+    # Generate the list of quoted names on each line of a boards.csv file.
+    # The first name on a line is canonical, the others are known variants.
+    # Lines whose canonical name is in discard are skipped.
+    csv = re.compile('("[^"]+")+')
+    with open_stream(path) as source:
+        for line in source:
+            item = [phrase.strip('"') for phrase in csv.findall(line)]
+            if item and item[0].upper() not in discard:
+                yield item
+
+
+def read_lines(paths):
+    # Generate the lines of each input file without their line endings.
+    for path in paths:
+        source = open_stream(path)
+        try:
+            for line in source:
+                yield line.rstrip('\r\n')
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+
+def generate_chunks(iterable, size):
+    # Generate lists of up to size consecutive items.
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def add_dictionary_options(parser):
+    # Options choosing the dictionary and how it is matched.
+    parser.add_option('-b', '--boards', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'boards.csv'),
+        help='canonical names, first column of each line [%default]')
+    parser.add_option('-i', '--index',
+        help='load a saved index instead of the boards file')
+    parser.add_option('-a', '--algorithms', default='cefLmNs',
+        help='algorithm letters to use [%default]')
+    parser.add_option('-k', '--keyboard', default='QWERTY',
+        help='keyboard for fat fingers, or several comma separated, '
+        'of %s [%%default]' % string.join(sorted(Similar.keyboard), ', '))
+    parser.add_option('-C', '--cache', type='int', default=0,
+        help='size of the result cache, 0 for none [%default]')
+    parser.add_option('-N', '--negative', type='int', default=10000,
+        help='size of the cache of failures, 0 for none [%default]')
+    parser.add_option('-B', '--bloom', action='store_true',
+        help='reject inputs whose first word matches nothing '
+        'with a Bloom filter before searching')
+    parser.add_option('-A', '--aliases', action='append', default=[],
+        help='make the matches of a good csv file aliases, when filling '
+        'from the boards file (repeatable)')
+    parser.add_option('-J', '--joins', type='int', default=0,
+        help='most words one run together may match, 0 for none '
+        '[%default]')
+
+
+def load_dictionary(options, **kw):
+    # Make a Similar from the dictionary options, loading or filling it.
+    similar = Similar(algorithms=options.algorithms,
+            keyboard=options.keyboard, cache=options.cache,
+            joins=options.joins, negative=options.negative,
+            bloom=options.bloom, **kw)
+    if options.index:
+        similar.load_index(options.index)
+    else:
+        for item in read_boards(options.boards):
+            similar.fill_board(item)
+        for path in options.aliases:
+            similar.absorb(path)
+    return similar
+
+
+def canonicalize(argv):
+    # The command-line canonicalizer.
+    # Dirty names stream from files or stdin through canonicalize_many
+    # a chunk at a time, and good/fail results are written a block at a time.
+    parser = optparse.OptionParser(
+            usage='%prog canonicalize [options] [input ...]',
+            description='Canonicalize the dirty names, one per line, '
+            'of each input (stdin by default, .gz and .bz2 accepted).')
+    add_dictionary_options(parser)
+    parser.add_option('-g', '--good', default='Good.csv',
+        help='canonicalized output, - for stdout [%default]')
+    parser.add_option('-f', '--fail', default='Fail.csv',
+        help='uncanonicalized output, - for stdout [%default]')
+    parser.add_option('-l', '--log',
+        help='matching log, single process only [Similar.log]')
+    parser.add_option('-n', '--no-log', action='store_true',
+        help='write no matching log at all')
+    parser.add_option('-t', '--sample', type='int', default=1000,
+        help='log the matches of one call in this many [%default]')
+    parser.add_option('-c', '--chunk', type='int', default=10000,
+        help='lines canonicalized together [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help='worker processes, 0 for one per core [%default]')
+    parser.add_option('-S', '--stats', action='store_true',
+        help='print profiling counters to stderr (single process only)')
+    options, inputs = parser.parse_args(argv)
+    # Worker processes trace nothing, so a log is only written by one.
+    if options.log and options.jobs != 1:
+        parser.error('--log is single process only')
+    logged = options.jobs == 1 and not options.no_log
+
+    good = open_stream(options.good, 'w')
+    fail = open_stream(options.fail, 'w')
+    log = open_stream(options.log or 'Similar.log', 'w') if logged else None
+    similar = load_dictionary(options, output=log, good=good, fail=fail,
+            statistics=options.stats, sample=options.sample)
+
+    lines = read_lines(inputs or ['-'])
+    if options.jobs == 1:
+        results = itertools.chain.from_iterable(itertools.imap(
+            similar.canonicalize_many, generate_chunks(lines, options.chunk)))
+    else:
+        results = similar.canonicalize_parallel(
+                lines, options.jobs, options.chunk)
+    count, match = 0, 0
+    for matchBool, canonical, used in results:
+        count += 1
+        match += bool(matchBool and canonical)
+
+    similar.close()
+    for stream in (good, fail, log):
+        if stream and stream is not sys.stdout:
+            stream.close()
+    print>>sys.stderr, 'Canonicalized %d/%d' % (match, count)
+    if options.stats:
+        json.dump(similar.stats(), sys.stderr, indent=1, sort_keys=True)
+        print>>sys.stderr
+    return 0
+
+
+class Pending(object):
+    # One request waiting in a Batcher for its result.
+
+    __slots__ = ('rough', 'result', 'done')
+
+    def __init__(self, rough):
+        self.rough = rough
+        self.result = None
+        self.done = threading.Event()
+
+
+class Batcher(threading.Thread):
+    # A thread resolving requests from many connections in micro-batches.
+    # The first request of a batch waits at most window seconds for others
+    # (up to size of them), and the batch is resolved together,
+    # so repeated names within it are resolved only once.
+    # Given a boards file, it applies the changes made to it between
+    # batches, looking at most once in interval seconds, so that
+    # no update races a resolve.
+
+    def __init__(self, similar, window=0.005, size=1000, boards=None,
+            interval=1.0):
+        threading.Thread.__init__(self, name='Batcher')
+        self.daemon = True
+        self.similar, self.window, self.size = similar, window, size
+        self.queue = Queue.Queue()
+        self.boards, self.interval = boards, interval
+        self.stamp, self.checked = self.modified(), time.time()
+
+    def modified(self):
+        # The modification time and size of the boards file, if any.
+        try:
+            status = os.stat(self.boards)
+        except (TypeError, OSError):
+            return None
+        return status.st_mtime, status.st_size
+
+    def refresh(self):
+        # Update the dictionary if the boards file has changed.
+        # The file is stamped only once an update succeeds, so that
+        # a failed one is tried again at the next check.
+        now = time.time()
+        if not self.boards or now - self.checked < self.interval:
+            return
+        self.checked = now
+        stamp = self.modified()
+        if stamp is not None and stamp != self.stamp:
+            try:
+                counts = self.similar.update_from_csv(self.boards)
+                print>>sys.stderr, 'Reloaded %s: %d added, ' \
+                        '%d removed, %d changed' % ((self.boards,) + counts)
+                self.stamp = stamp
+            except Exception as error:
+                print>>sys.stderr, 'Reloading %s failed: %s' % (
+                        self.boards, error)
+
+    def resolve_batch(self, roughs):
+        # Resolve the rough inputs of a batch together.  If that fails,
+        # each is resolved alone, so that only a bad input fails (None).
+        # Failures are logged to stderr.
+        try:
+            return self.similar.resolve_many(roughs)
+        except Exception as error:
+            print>>sys.stderr, 'Resolving a batch of %d failed: %r' % (
+                    len(roughs), error)
+        results = []
+        for rough in roughs:
+            try:
+                results.extend(self.similar.resolve_many([rough]))
+            except Exception as error:
+                print>>sys.stderr, 'Resolving %r failed: %r' % (rough, error)
+                results.append(None)
+        return results
+
+    def submit(self, rough):
+        # Resolve one rough input, waiting for its batch to finish.
+        pending = Pending(rough)
+        self.queue.put(pending)
+        pending.done.wait()
+        return pending.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(True, timeout))
+                except Queue.Empty:
+                    break
+            self.refresh()
+            results = self.resolve_batch([pending.rough for pending in batch])
+            for pending, result in zip(batch, results):
+                pending.result = result
+                pending.done.set()
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    # One connection: a dirty name per line in, a JSON object per line out.
+    # The object has the rough name, match, canonical and used,
+    # canonical being a sorted list when an acronym is ambiguous,
+    # or an error when the name could not be resolved.
+    # Names are replied as unicode, bytes that are not UTF-8 being
+    # taken to be Latin-1, as they are when lexed.
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            rough = line.rstrip('\r\n')
+            result = self.server.batcher.submit(rough)
+            if result is None:
+                reply = {'rough': collation(rough), 'error': 'unresolved'}
+            else:
+                matchBool, canonical, used = result
+                if isinstance(canonical, (set, frozenset)):
+                    canonical = map(collation,
+                            sorted(canonical, key=collation))
+                else:
+                    canonical = collation(canonical)
+                reply = {'rough': collation(rough), 'match': bool(matchBool),
+                        'canonical': canonical, 'used': used}
+            self.wfile.write(json.dumps(reply) + '\n')
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(similar, address, window=0.005, size=1000, boards=None,
+        interval=1.0):
+    # Make a server resolving names through one resident Similar.
+    # An address string is a Unix socket path, a tuple a (host, port).
+    # Changes to a boards file, if given, are applied while serving.
+    if isinstance(address, basestring):
+        server = UnixServer(address, Handler)
+    else:
+        server = TCPServer(address, Handler)
+    server.batcher = Batcher(similar, window, size, boards, interval)
+    server.batcher.start()
+    return server
+
+
+def serve(argv):
+    # The resident canonicalization service.
+    parser = optparse.OptionParser(
+            usage='%prog serve [options]',
+            description='Serve canonicalization of dirty names, '
+            'one per line, answering each with a line of JSON.')
+    add_dictionary_options(parser)
+    parser.add_option('-u', '--unix',
+        help='listen on this Unix socket path')
+    parser.add_option('-p', '--port', type='int', default=8737,
+        help='otherwise listen on this localhost port [%default]')
+    parser.add_option('-w', '--window', type='float', default=5.0,
+        help='milliseconds to gather a batch [%default]')
+    parser.add_option('-s', '--size', type='int', default=1000,
+        help='largest batch [%default]')
+    parser.add_option('-r', '--reload', type='float', default=0,
+        help='seconds between looking for changes to the boards file, '
+        'applied while serving, 0 for never [%default]')
+    options, args = parser.parse_args(argv)
+
+    similar = load_dictionary(options)
+    address = options.unix or ('127.0.0.1', options.port)
+    boards = options.boards if options.reload else None
+    server = make_server(similar, address, options.window / 1000.0,
+            options.size, boards, options.reload)
+    print>>sys.stderr, 'Serving on', address
+    signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.unix:
+            os.remove(options.unix)
+    return 0
+
 
 if __name__ == "__main__":
 
@@ -668,6 +2981,12 @@ if __name__ == "__main__":
     import os.path
     import unittest
     import datetime
+    import shutil
+    import random
+    import socket
+    import StringIO
+    import warnings
+    import tempfile
 
     class Results(object):
 
@@ -740,6 +3059,7 @@ if __name__ == "__main__":
                     output=self.log, good=self.good, fail=self.fail)
 
         def tearDown(self):
+            self.similar.close()
             if self.good:
                 self.good.close()
             if self.fail:
@@ -747,6 +3067,11 @@ if __name__ == "__main__":
             if self.log:
                 self.log.close()
 
+        def words(self, similar, tokens):
+            # The sorted tokens of token ids.
+            return sorted([similar.vocabulary.tokens[token]
+                for token in tokens])
+
         def test_000_empty(self):
 
             self.clear(self.log)
@@ -1115,7 +3440,7 @@ if __name__ == "__main__":
 
             #print '\t\t', final
             #print '\t\t', self.similar.root
-            self.assertEqual(self.similar.root, final)
+            self.assertEqual(self.similar.expand(), final)
 
         def test_009_CSV(self):
             csv = re.compile('("[^"]+")+')
@@ -1159,5 +3484,990 @@ if __name__ == "__main__":
             else:
                 print result
 
-
+        def test_010_canonicalize_many(self):
+            names = [
+                    u"Massachusetts Institute of Technology",
+                    u"American Board of Internal Medicine"]
+            rough = [
+                    u"Masachusetts Institute of Technology",
+                    u"MIT",
+                    u"Amer Bd Int Med",
+                    u"Nothing like it",
+                    u"masachusetts institute technology",
+                    u"Amer. Bd. of Int'l Med.",
+                    u"MIT"]
+            for name in names:
+                self.similar.fill_arbor(name)
+            expect = [self.similar(text) for text in rough]
+            self.assertEqual(self.similar.canonicalize_many(rough), expect)
+            self.assertEqual(self.similar.canonicalize_many([]), [])
+
+        def test_011_cache(self):
+            similar = Similar(cache=2)
+            similar.fill_arbor(u"Massachusetts Institute of Technology")
+            rough = u"Masachusetts Institute of Technology"
+            first = similar(rough)
+            self.assertEqual(similar(rough), first)
+            self.assertEqual(similar(u"Masachusetts Institute Technology"),
+                    first)
+            similar(u"Nothing like it")
+            similar(u"Nothing at all")
+            self.assertEqual(similar.cache.counts(), {
+                    'size': 2, 'hits': 2, 'misses': 3, 'evictions': 1})
+
+            # Changing the arbor must discard cached results.
+            similar.fill_arbor(u"Nothing like it")
+            self.assertEqual(len(similar.cache), 0)
+            self.assertTrue(similar(u"Nothing like it")[0])
+            self.assertEqual(Similar().cache, None)
+
+            # As does choosing other algorithms.
+            similar = Similar(algorithms='e', cache=10, negative=0)
+            similar.fill_arbor(u"Mercy General")
+            self.assertFalse(similar(u"Mercy Genral")[0])
+            similar.control['algorithms'] = 'eL'
+            self.assertEqual(similar(u"Mercy Genral"),
+                    (True, u"Mercy General", '.L'))
+
+        def test_012_deletes(self):
+            similar = Similar(algorithms='L')
+            for text in [u"cat one", u"cart two", u"dog three"]:
+                similar.fill_arbor(text)
+            root, words = similar.root, lambda ids: self.words(similar, ids)
+            self.assertEqual(words(root.deletes[u'CAT']), [u'CART', u'CAT'])
+            self.assertEqual(words(root.deletes[u'OG']), [u'DOG'])
+            self.assertEqual(
+                    words(similar.generate_candidates(root, u'CATS')),
+                    [u'CART', u'CAT'])
+            self.assertEqual(similar.generate_candidates(root, u'XYZ'), [])
+            self.assertEqual(similar(u"cst one")[1], u"cat one")
+            self.assertEqual(similar(u"dgo three")[1], u"dog three")
+            self.assertFalse(similar(u"cattle two")[0])
+
+        def test_013_phonetic(self):
+            pairs = [
+                    ('s', u"MASSACHUSETTS", u"MASACHUSETS"),
+                    ('m', u"PHYSICIAN", u"FYSICIAN"),
+                    ('N', u"KNIGHT", u"NIGHT"),
+                    ]
+            for letter, canon, rough in pairs:
+                algorithm = self.similar.master_algorithm_list[letter]
+                self.assertTrue(algorithm['algorithm'](canon, rough))
+                self.assertFalse(algorithm['algorithm'](canon, u"BOARD"))
+
+            similar = Similar(algorithms='s')
+            for text in [u"Massachusetts General", u"Mercy General"]:
+                similar.fill_arbor(text)
+            root, words = similar.root, lambda ids: self.words(similar, ids)
+            self.assertEqual(sorted(root.soundex), ['M232', 'M620'])
+            self.assertEqual(words(root.soundex['M232']), [u'MASSACHUSETTS'])
+            self.assertEqual(words(root.soundex['M620']), [u'MERCY'])
+            self.assertEqual(
+                    words(similar.generate_candidates(root, u'MERSY')),
+                    [u'MERCY'])
+            self.assertEqual(similar(u"Mersy General")[1], u"Mercy General")
+            self.assertFalse(similar(u"Boston General")[0])
+
+        def test_014_buckets(self):
+            similar = Similar()
+            for text in [u"fat one", u"fit two", u"fast three", u"cat four",
+                    u"finger five"]:
+                similar.fill_arbor(text)
+            root, words = similar.root, lambda ids: self.words(similar, ids)
+            self.assertEqual(words(root.lengths[3]), [u'CAT', u'FAT', u'FIT'])
+            self.assertEqual(words(root.leads[u'F']),
+                    [u'FAST', u'FAT', u'FINGER', u'FIT'])
+            self.assertEqual(words(root.tails[u'R']), [u'FINGER'])
+
+            similar.control['algorithms'] = 'f'
+            self.assertEqual(words(similar.generate_candidates(root, u'GAT')),
+                    [u'CAT', u'FAT', u'FIT'])
+            similar.control['algorithms'] = 'c'
+            self.assertEqual(words(similar.generate_candidates(root, u'FGR')),
+                    [u'FAST', u'FAT', u'FINGER', u'FIT'])
+            self.assertEqual(len(similar.generate_candidates(root, u'F')), 5)
+            self.assertEqual(similar(u"Fing five")[1], u"finger five")
+
+        def test_015_freeze(self):
+            names = [
+                    u"Massachusetts Institute of Technology",
+                    u"Massachusetts General Hospital",
+                    u"Mercy General Hospital",
+                    u"American Board of Internal Medicine"]
+            rough = [
+                    u"Masachusetts Institute of Technology",
+                    u"Massachusetts Genral Hospital",
+                    u"Mersy General Hospital",
+                    u"Amer Bd Int Med",
+                    u"Nothing like it"]
+            similar = Similar()
+            for name in names:
+                similar.fill_arbor(name)
+            expect = [similar(text) for text in rough]
+            similar.freeze()
+            root, tokens = similar.root, similar.vocabulary.tokens
+            token = similar.vocabulary.get
+            self.assertTrue(isinstance(root, FrozenBranch))
+            self.assertEqual(tokens, sorted(tokens))
+            self.assertEqual([tokens[i] for i in root.children()],
+                    [u'AMERICAN', u'MASSACHUSETTS', u'MERCY'])
+            self.assertEqual(root[token(u'MERCY')][token(u'GENERAL')][
+                token(u'HOSPITAL')][u'.'], u"Mercy General Hospital")
+            self.assertEqual(root[token(u'MERCY')][u'#'], 1)
+            self.assertEqual(root.get(token(u'MERCY')).get(u'.'), None)
+            self.assertEqual(root.get(u'MERCY'), None)
+            self.assertFalse(u'#' in root.children())
+            self.assertEqual([tokens[i] for i in root.lookup('leads', [u'M'])],
+                    [u'MASSACHUSETTS', u'MERCY'])
+            self.assertEqual(similar.acro[token(u'MIT')], set(
+                    [u"Massachusetts Institute of Technology"]))
+            self.assertEqual([similar(text) for text in rough], expect)
+            self.assertRaises(TypeError, similar.fill_arbor, u"Anything")
+
+        def test_016_index_file(self):
+            names = [
+                    u"Massachusetts Institute of Technology",
+                    u"Massachusetts General Hospital",
+                    u"Mercy General Hospital",
+                    "H\xc3\xb4pital Universitaire",
+                    u"H\xf4pital Unique",
+                    "American Board of Internal Medicine"]
+            rough = [
+                    u"Masachusetts Institute of Technology",
+                    u"Massachusetts Genral Hospital",
+                    u"Mersy General Hospital",
+                    u"Amer Bd Int Med",
+                    u"MIT",
+                    "Hpital Universitaire",
+                    u"Nothing like it"]
+            similar = Similar()
+            for name in names:
+                similar.fill_arbor(name)
+            expect = [similar(text) for text in rough]
+            path = os.path.join(tempfile.mkdtemp(), 'boards.idx')
+            similar.save_index(path)
+
+            loaded = Similar().load_index(path)
+            self.assertTrue(isinstance(loaded.root.arbor.edges, MappedArray))
+            self.assertEqual([loaded(text) for text in rough], expect)
+            self.assertEqual(loaded.root.children(), similar.root.children())
+            self.assertEqual(list(loaded.vocabulary.tokens),
+                    similar.vocabulary.tokens)
+            self.assertEqual(loaded.expand(), similar.expand())
+            token = loaded.vocabulary.get
+            hospital = loaded.root[token(u'MERCY')][token(u'GENERAL')][
+                    token(u'HOSPITAL')]
+            self.assertEqual(hospital[u'.'], u"Mercy General Hospital")
+            self.assertEqual(hospital[u'.dmeta'],
+                    similar.dmeta(u"Mercy General Hospital"))
+            self.assertEqual(loaded.acro[token(u'ABIM')], set(
+                    ["American Board of Internal Medicine"]))
+            # Byte str and unicode names of one acronym are saved together.
+            self.assertEqual(loaded.acro[token(u'HU')], set(
+                    ["H\xc3\xb4pital Universitaire", u"H\xf4pital Unique"]))
+            self.assertRaises(TypeError, loaded.fill_arbor, u"Anything")
+
+            with open(path, 'r+b') as index:
+                index.seek(8)
+                index.write(struct.pack('<I', 99))
+            self.assertRaises(ValueError, Similar().load_index, path)
+            os.remove(path)
+
+        def test_017_canonicalize(self):
+            directory = tempfile.mkdtemp()
+            def named(name):
+                return os.path.join(directory, name)
+            with open(named('boards.csv'), 'w') as target:
+                print>>target, '"Massachusetts Institute of Technology" "MIT"'
+                print>>target, '"Other" "Anything"'
+                print>>target, '"American Board of Internal Medicine"'
+            self.assertEqual(list(read_boards(named('boards.csv'))), [
+                    ['Massachusetts Institute of Technology', 'MIT'],
+                    ['American Board of Internal Medicine']])
+
+            source = gzip.open(named('dirty.txt.gz'), 'wb')
+            source.write('MIT\r\nAmer Bd Int Med\nNothing like it\nMIT\n')
+            source.close()
+            status = canonicalize([
+                    '--boards', named('boards.csv'),
+                    '--good', named('good.csv.bz2'),
+                    '--fail', named('fail.csv'),
+                    '--no-log', '--chunk', '2',
+                    named('dirty.txt.gz')])
+            self.assertEqual(status, 0)
+            # "MIT" is a known variant on its boards line, so an alias.
+            self.assertEqual(bz2.BZ2File(named('good.csv.bz2')).read(),
+                '"Massachusetts Institute of Technology", "MIT"\n'
+                '"American Board of Internal Medicine", "Amer Bd Int Med"\n'
+                '"Massachusetts Institute of Technology", "MIT"\n')
+            self.assertEqual(open(named('fail.csv')).read(),
+                    '"Nothing like it"\n')
+            self.assertFalse(os.path.exists(named('Similar.log')))
+            stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+            try:
+                self.assertRaises(SystemExit, canonicalize, [
+                    '--boards', named('boards.csv'),
+                    '--log', named('Similar.log'), '--jobs', '2',
+                    named('dirty.txt.gz')])
+                self.assertTrue('single process' in sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+            self.assertFalse(os.path.exists(named('Similar.log')))
+            shutil.rmtree(directory)
+
+        def test_018_parallel(self):
+            names = [
+                    u"Massachusetts Institute of Technology",
+                    u"American Board of Internal Medicine"]
+            rough = [
+                    u"Masachusetts Institute of Technology",
+                    u"MIT",
+                    u"Amer Bd Int Med",
+                    u"Nothing like it",
+                    u"masachusetts institute technology"] * 7
+            good, fail = StringIO.StringIO(), StringIO.StringIO()
+            similar = Similar(good=good, fail=fail)
+            for name in names:
+                similar.fill_arbor(name)
+            expect = similar.canonicalize_many(rough)
+            lines = good.getvalue(), fail.getvalue()
+            good.truncate(0)
+            fail.truncate(0)
+
+            results = similar.canonicalize_parallel(iter(rough), 2, 3)
+            self.assertEqual(list(results), expect)
+            self.assertEqual((good.getvalue(), fail.getvalue()), lines)
+            self.assertEqual(list(similar.canonicalize_parallel([], 2)), [])
+
+        def test_019_threads(self):
+            names = [
+                    u"Massachusetts Institute of Technology",
+                    u"Massachusetts General Hospital",
+                    u"Mercy General Hospital",
+                    u"American Board of Internal Medicine"]
+            rough = [
+                    u"Masachusetts Institute of Technology",
+                    u"Massachusetts Genral Hospital",
+                    u"Mersy General Hospital",
+                    u"Amer Bd Int Med",
+                    u"Nothing like it",
+                    u"Massachusets Genral Hopsital"]
+            similar = Similar(cache=3)
+            for name in names:
+                similar.fill_arbor(name)
+            expect = [similar(text) for text in rough]
+            similar.generate_head_tail_indices(u"ABCD", u"ABXD")
+            self.assertFalse(hasattr(similar, 'head'))
+            self.assertFalse(hasattr(similar, 'using'))
+
+            failures = []
+            def work(offset):
+                for n in range(200):
+                    i = (n + offset) % len(rough)
+                    if similar(rough[i]) != expect[i]:
+                        failures.append(rough[i])
+            threads = [threading.Thread(target=work, args=(n,))
+                    for n in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(failures, [])
+
+        def test_020_serve(self):
+            similar = Similar()
+            for name in [u"Massachusetts Institute of Technology",
+                    u"American Board of Internal Medicine"]:
+                similar.fill_arbor(name)
+            directory = tempfile.mkdtemp()
+            address = os.path.join(directory, 'similar.sock')
+            server = make_server(similar, address, window=0.02)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            replies = {}
+            def client(name, lines):
+                connection = socket.socket(socket.AF_UNIX)
+                connection.connect(address)
+                stream = connection.makefile('r+', 0)
+                replies[name] = []
+                for line in lines:
+                    stream.write(line + '\n')
+                    replies[name].append(json.loads(stream.readline()))
+                connection.close()
+            lines = ['MIT', 'Amer Bd Int Med', 'Nothing like it',
+                    'H\xf4pital']
+            clients = [threading.Thread(target=client, args=(n, lines))
+                    for n in range(4)]
+            for each in clients:
+                each.start()
+            for each in clients:
+                each.join()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            shutil.rmtree(directory)
+
+            expect = [
+                    {'rough': 'MIT', 'match': True, 'used': '',
+                        'canonical': [
+                            'Massachusetts Institute of Technology']},
+                    {'rough': 'Amer Bd Int Med', 'match': True, 'used': 'cccc',
+                        'canonical': 'American Board of Internal Medicine'},
+                    {'rough': 'Nothing like it', 'match': False, 'used': '',
+                        'canonical': ''},
+                    {'rough': u'H\xf4pital', 'match': False, 'used': '',
+                        'canonical': ''}]
+            self.assertEqual(replies, dict((n, expect) for n in range(4)))
+
+            # A batch that fails is resolved input by input,
+            # so that only the bad input fails.
+            batcher = Batcher(similar)
+            resolve_many = similar.resolve_many
+            def fragile(roughs):
+                if 'bad' in roughs:
+                    raise ValueError('bad input')
+                return resolve_many(roughs)
+            similar.resolve_many = fragile
+            stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+            try:
+                results = batcher.resolve_batch(['MIT', 'bad', 'MIT'])
+                self.assertTrue('bad input' in sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(results[1], None)
+            self.assertEqual(results[0], results[2])
+            self.assertEqual(results[0][1],
+                    set([u"Massachusetts Institute of Technology"]))
+
+        def test_021_benchmark(self):
+            import Benchmark
+            rng = random.Random(1)
+            seeds = [u"Massachusetts Institute of Technology"]
+            names = Benchmark.generate_names(seeds, 30, rng)
+            self.assertEqual(len(set(names)), 30)
+            self.assertEqual(names[0], seeds[0])
+            dirty = Benchmark.Dirty(rng)
+            self.assertEqual(dirty.acronym(seeds[0]), u"MIT")
+            self.assertEqual(len(dirty.delete(seeds[0])), len(seeds[0]) - 1)
+            self.assertTrue(dirty.contraction(u"International Bd") in [
+                    u"Int'l Bd", u"In. Bd", u"Int. Bd", u"Inte. Bd"])
+            samples = list(dirty(names, 16))
+            self.assertEqual([model for rough, name, model in samples],
+                    Benchmark.MODELS * 2)
+
+            results = Benchmark.benchmark(seeds, [20], 16, ['e', 'cefLmNs'])
+            self.assertEqual([(r['size'], r['algorithms']) for r in results],
+                    [(20, 'e'), (20, 'cefLmNs')])
+            self.assertEqual(results[0]['correct_by_model']['exact'], 1.0)
+            self.assertTrue(
+                    results[1]['correct_rate'] >= results[0]['correct_rate'])
+
+        def test_022_statistics(self):
+            similar = Similar(algorithms='eL')
+            self.assertEqual(similar.stats(), None)
+            for name in [u"Massachusetts Institute of Technology",
+                    u"American Board of Internal Medicine"]:
+                similar.fill_arbor(name)
+            similar.enable_statistics()
+            similar(u"MIT")
+            similar(u"Massachusefts Institute of Technology")
+            similar(u"Nothing like it")
+            stats = similar.stats()
+            self.assertEqual(stats['answers'],
+                    {'acronym': 1, 'trie': 1, 'none': 1})
+            self.assertEqual(stats['levels'], {
+                    0: {'visits': 2, 'scanned': 1}})
+            L = stats['algorithms']['L']
+            self.assertEqual((L['calls'], L['hits']), (1, 1))
+            self.assertTrue(L['seconds'] > 0)
+            self.assertEqual(stats['algorithms']['c']['calls'], 0)
+
+            similar.enable_statistics(False)
+            self.assertEqual(similar.stats(), None)
+            algorithm = similar.master_algorithm_list['L']['algorithm']
+            self.assertEqual(algorithm, similar.bool_algorithm_Levenshtein1)
+
+        def test_023_trace(self):
+            log = StringIO.StringIO()
+            similar = Similar(algorithms='eL', output=log, sample=2)
+            similar.fill_arbor(u"Massachusetts Institute of Technology")
+            similar(u"Massachusefts Institute of Technology")
+            similar(u"Massachusefts Institute of Technology")
+            similar(u"MIT")
+            similar.close()
+            records = [json.loads(line) for line in log.getvalue().splitlines()]
+            self.assertEqual([record['event'] for record in records],
+                    ['match', 'match', 'match', 'call', 'call'])
+            self.assertEqual(records[0], {'event': 'match', 'level': 0,
+                'algorithm': 'L', 'rough': u'MASSACHUSEFTS',
+                'canon': u'MASSACHUSETTS'})
+            self.assertEqual(records[3]['used'], 'L..')
+            self.assertEqual(records[4]['canonical'],
+                    [u"Massachusetts Institute of Technology"])
+
+            # Without an output nothing is traced, and no thread is started.
+            similar = Similar(algorithms='eL')
+            self.assertEqual(similar.trace, None)
+            self.assertEqual(similar.context().trace, None)
+
+        def test_024_lex_many(self):
+            roughs = [
+                    u"University of Arizona",
+                    u"Amer. Bd. of Int'l Med. (AB-IM), Inc.",
+                    "  Hello  world!",
+                    u"The Board \u4e2d of the",
+                    "Caf\xe9 du Monde",
+                    u"",
+                    u"/ Nothing",
+                    u"Fish, Wildlife and Parks"]
+            self.assertEqual(self.similar.lex_line(roughs[0]),
+                    [u"UNIVERSITY", u"ARIZONA"])
+            self.assertEqual(self.similar.lex_line(roughs[1]),
+                    [u"AMER", u"BD", u"INT'L", u"MED"])
+            self.assertEqual(self.similar.lex_line(roughs[3]),
+                    [u"BOARD", u"\u4e2d"])
+            self.assertEqual(self.similar.lex_line(roughs[4]),
+                    [u"CAFE", u"DU", u"MONDE"])
+            self.assertEqual(self.similar.lex_line(roughs[7]), [u"FISH"])
+            expect = [self.similar.lex_line(rough) for rough in roughs]
+            self.assertEqual(self.similar.lex_many(roughs), expect)
+            self.assertEqual(
+                    self.similar.lex_many(roughs[2:5:2]), expect[2:5:2])
+            self.assertEqual(self.similar.lex_many([]), [])
+
+        def test_025_unicode_folding(self):
+            pairs = [
+                    ([u"HOPITAL", u"UNIVERSITAIRE"],
+                        u"H\xf4pital Universitaire"),
+                    ([u"HOPITAL", u"UNIVERSITAIRE"],
+                        "H\xc3\xb4pital Universitaire"),
+                    ([u"HOPITAL"], "H\xf4pital"),
+                    ([u"ECOLE"], u"E\u0301cole"),
+                    ([u"FINANCE", u"STRASSE"], u"\ufb01nance Stra\xdfe"),
+                    ([u"ABC", u"DE"], u"\uff21\uff22\uff23\xa0De"),
+                    ([u"\u041c\u041e\u0421\u041a\u0412\u0410"],
+                        u"\u041c\u043e\u0441\u043a\u0432\u0430"),
+                    ]
+            for expect, rough in pairs:
+                self.assertEqual(self.similar.lex_line(rough), expect)
+            self.assertEqual(self.similar.lex_many([rough
+                for expect, rough in pairs]), [expect
+                    for expect, rough in pairs])
+
+            similar = Similar(algorithms='eLs')
+            similar.fill_arbor(u"H\xf4pital Universitaire")
+            similar.fill_arbor(u"\u041c\u043e\u0441\u043a\u0432\u0430")
+            for rough in [u"Hopital Universitaire",
+                    "H\xc3\xb4pital universitaire"]:
+                self.assertEqual(similar(rough),
+                        (True, u"H\xf4pital Universitaire", '..'))
+            self.assertEqual(similar(u"\u041c\u043e\u0441\u043a\u0432\u0430"),
+                    (True, u"\u041c\u043e\u0441\u043a\u0432\u0430", '.'))
+            self.assertEqual(
+                    similar.record(u"H\xf4pital", True, u"H\xf4pital")[1],
+                    '"H\xc3\xb4pital", "H\xc3\xb4pital"\n')
+
+        def test_026_rank(self):
+            similar = Similar()
+            for name in [u"Massachusetts General Hospital",
+                    u"Marshall General Hospital",
+                    u"Mercy General Hospital",
+                    u"Massachusetts Institute of Technology"]:
+                similar.fill_arbor(name)
+            self.assertTrue(similar.bool_algorithm_Levenshtein1(
+                u"MASSACHUSETTS", u"MASACHUSETTS"))
+            ranked = similar.rank(u"Masachusetts General Hospital", 2)
+            self.assertEqual([(canonical, used)
+                for score, canonical, used in ranked], [
+                    (u"Massachusetts General Hospital", 'L..'),
+                    (u"Marshall General Hospital", 'c..')])
+            self.assertEqual(ranked[0][0], similar.costs['L'])
+            self.assertEqual(similar.rank(u"Mass Gen Hosp", 1)[0][1],
+                    u"Massachusetts General Hospital")
+            self.assertEqual(similar.rank(u"Massachusetts General Hospital "
+                "Boston", 1), [(similar.costs['-'],
+                    u"Massachusetts General Hospital", '...')])
+            self.assertEqual(similar.rank(u"MIT"), [(similar.costs['A'],
+                    u"Massachusetts Institute of Technology", 'A')])
+            self.assertEqual(similar.rank(u"Nothing like it"), [])
+            for rough in [u"Mersy Genral Hospital", u"Gen Hosp"]:
+                every = similar.rank(rough, None)
+                for k in [1, 2, 3]:
+                    self.assertEqual([score for score, canonical, used
+                        in similar.rank(rough, k)],
+                        [score for score, canonical, used in every[:k]])
+
+            # Byte str and unicode names of equal score are ranked together.
+            similar.fill_arbor("H\xc3\xb4pital G\xc3\xa9n\xc3\xa9ral")
+            similar.fill_arbor(u"H\xf4pital G\xe9n\xe9reux")
+            similar.fill_arbor(u"Hopital Generique")
+            self.assertEqual(similar.rank(u"HG", None), [
+                (similar.costs['A'], u"Hopital Generique", 'A'),
+                (similar.costs['A'], "H\xc3\xb4pital G\xc3\xa9n\xc3\xa9ral",
+                    'A'),
+                (similar.costs['A'], u"H\xf4pital G\xe9n\xe9reux", 'A')])
+
+        def test_027_Levenshtein_k(self):
+            trie = CharacterTrie()
+            for i, token in enumerate([u'CAT', u'CART', u'CAST', u'ACT',
+                    u'COAT', u'DOG', u'CATS']):
+                trie.add(token, i)
+            self.assertEqual(trie.within(u'CAT', 0), {0: 0})
+            self.assertEqual(trie.within(u'CAT', 1),
+                    {0: 0, 1: 1, 2: 1, 3: 1, 4: 1, 6: 1})
+            self.assertEqual(trie.within(u'TAC', 2), {0: 2, 3: 2})
+            self.assertEqual(trie.within(u'', 3), {0: 3, 3: 3, 5: 3})
+
+            similar = Similar(algorithms='K')
+            for text in [u"Massachusetts General", u"Mercy General"]:
+                similar.fill_arbor(text)
+            # Two edits in a long token, but only one in a short one.
+            self.assertTrue(similar.bool_algorithm_Levenshtein(
+                u'MASSACHUSETTS', u'MASACHUSETS'))
+            self.assertFalse(similar.bool_algorithm_Levenshtein1(
+                u'MASSACHUSETTS', u'MASACHUSETS'))
+            self.assertTrue(similar.bool_algorithm_Levenshtein(
+                u'MERCY', u'MRECY'))
+            self.assertFalse(similar.bool_algorithm_Levenshtein(
+                u'MERCY', u'MRCI'))
+            self.assertTrue(similar.bool_algorithm_Levenshtein(
+                u'HOSPITAL', u'HSOPITLA'))
+            self.assertEqual(self.words(similar, similar.generate_candidates(
+                similar.root, u'MASACHUSETS')), [u'MASSACHUSETTS'])
+            self.assertEqual(similar(u"Masachusets Genral")[1],
+                    u"Massachusetts General")
+            self.assertEqual(similar.rank(u"Masachusets Genral"),
+                    [(1.5 ** 3, u"Massachusetts General", 'KK')])
+            self.assertFalse(similar(u"Mrcy Genrl")[0])
+
+            # Freezing renumbers tokens, and the walk with them.
+            similar.freeze()
+            self.assertEqual(similar(u"Masachusets Genral")[1],
+                    u"Massachusetts General")
+            self.assertTrue(similar(u"Mrecy General")[0])
+
+        def test_028_joins(self):
+            names = [u"University of Texas Health Sciences Center",
+                    u"Massachusetts Institute of Technology"]
+            similar = Similar(joins=3)
+            for name in names:
+                similar.fill_arbor(name)
+            self.assertEqual(similar.joins[u'UNIVERSITYOFTEXAS'],
+                    set([u'UNIVERSITY TEXAS']))
+            self.assertEqual(similar.joins[u'TEXASHEALTHSCIENCES'],
+                    set([u'TEXAS HEALTH SCIENCES']))
+            self.assertFalse(u'TEXASHEALTHSCIENCESCENTER' in similar.joins)
+            pairs = [
+                    (u"UniversityofTexas Health Sciences Center", 'JJ...'),
+                    (u"University of Texas HealthSciences Center", '..JJ.'),
+                    (u"University of TexasHealthSciences Center", '.JJJ.'),
+                    (u"Massachusetts Institute of Tech nology", '..S'),
+                    ]
+            for rough, used in pairs:
+                matchBool, canonical, found = similar(rough)
+                self.assertTrue(matchBool)
+                self.assertTrue(canonical in names)
+                self.assertEqual(found, used)
+            self.assertEqual(similar.rank(u"UniversityofTexas Health "
+                u"Sciences Center", 1), [(similar.costs['J'], names[0],
+                    'JJ...')])
+            self.assertEqual(similar.rank(u"University of TexasHealth"
+                u"Sciences Center", 1)[0][0], similar.costs['J'] ** 2)
+
+            # Without joins, neither is found exactly.
+            plain = Similar(algorithms='e')
+            for name in names:
+                plain.fill_arbor(name)
+            self.assertFalse(plain.joins)
+            self.assertFalse(
+                    plain(u"Massachusetts Institute of Tech nology")[0])
+
+            # The join table is saved with the index.
+            path = os.path.join(tempfile.mkdtemp(), 'joins.idx')
+            similar.save_index(path)
+            loaded = Similar(joins=3).load_index(path)
+            self.assertEqual(loaded.joins[u'UNIVERSITYOFTEXAS'],
+                    set([u'UNIVERSITY TEXAS']))
+            self.assertEqual(loaded(pairs[0][0])[1], names[0])
+
+        def test_029_aliases(self):
+            similar = Similar(algorithms='e')
+            items = list(read_boards(self.boardfile))
+            for item in items:
+                similar.fill_board(item)
+            for item in items:
+                for variant in item:
+                    self.assertEqual(similar(variant), (True, item[0], '='))
+            self.assertEqual(similar.aliases[u'MIT'],
+                    set(['Massachusetts Institute of Technology']))
+            # Anything lexing the same is the same variant.
+            self.assertEqual(similar(u"m.i.t.!")[1],
+                    'Massachusetts Institute of Technology')
+            self.assertEqual(similar.rank(u"MIT", 1), [(1.0,
+                'Massachusetts Institute of Technology', '=')])
+            self.assertFalse(similar(u"Masachusetts Inst")[0])
+
+            # Confirmed matches are absorbed, ambiguous acronyms are not.
+            path = os.path.join(tempfile.mkdtemp(), 'Good.csv')
+            with open(path, 'w') as target:
+                print>>target, '"Massachusetts Institute of Technology", ' \
+                        '"Masachusetts Inst"'
+                print>>target, '"set([\'A\', \'B\'])", "AB"'
+            similar.absorb(path)
+            self.assertEqual(similar(u"Masachusetts Inst"), (True,
+                'Massachusetts Institute of Technology', '='))
+            self.assertFalse(u'AB' in similar.aliases)
+
+            # A variant of two names is ambiguous.
+            similar.add_alias(u"mit", u"Mother Interest Trust")
+            self.assertEqual(similar(u"MIT")[1], set([u"Mother Interest "
+                u"Trust", 'Massachusetts Institute of Technology']))
+
+            # Byte str and unicode names are saved together.
+            similar.fill_board(["H\xc3\xb4pital Central", "H\xc3\xb4pital"])
+            similar.add_canonical(u"H\xf4pital Unique", [u"H\xf4pital"])
+
+            # The alias table is saved with the index, and read-only.
+            similar.save_index(path + '.idx')
+            loaded = Similar().load_index(path + '.idx')
+            self.assertEqual(loaded(u"Masachusetts Inst")[1],
+                    u'Massachusetts Institute of Technology')
+            self.assertEqual(loaded(u"H\xf4pital")[1], set(
+                ["H\xc3\xb4pital Central", u"H\xf4pital Unique"]))
+            self.assertEqual(loaded.boards["H\xc3\xb4pital Central"],
+                    set(["H\xc3\xb4pital"]))
+            self.assertEqual(loaded.boards[u"H\xf4pital Unique"],
+                    set([u"H\xf4pital"]))
+            self.assertRaises(TypeError, loaded.add_alias, u"x", u"y")
+            shutil.rmtree(os.path.dirname(path))
+
+        def test_030_negative(self):
+            similar = Similar(algorithms='eL', statistics=True, negative=10)
+            similar.fill_arbor(u"Mercy General")
+            for n in range(3):
+                self.assertFalse(similar(u"Nothing like it")[0])
+            self.assertEqual(similar.stats()['answers'],
+                    {'none': 1, 'negative': 2})
+            # Filling the dictionary forgets the failures.
+            similar.fill_arbor(u"Nothing like it")
+            self.assertTrue(similar(u"Nothing like it")[0])
+            self.assertEqual(len(similar.negative), 0)
+            # As does choosing other algorithms.
+            self.assertFalse(similar(u"Meecu General")[0])
+            similar.control['algorithms'] = 'eLf'
+            self.assertTrue(similar(u"Meecu General")[0])
+            # Or any other control changing what matches.
+            joined = Similar(algorithms='e', joins=2)
+            joined.fill_arbor(u"Mercy General")
+            joined.control['joins'] = 0
+            self.assertFalse(joined(u"MercyGeneral")[0])
+            joined.control['joins'] = 2
+            self.assertTrue(joined(u"MercyGeneral")[0])
+            joined.control['keyboard'] = ['QWERTY', 'DVORAK']
+            self.assertFalse(joined(u"Nothing like it")[0])
+            self.assertEqual(len(joined.negative), 2)
+
+            # The prefilter rejects a first token matching no root child,
+            # and agrees with the arbor on every other input.
+            bloom = Similar(algorithms='efLmNs', bloom=True, negative=0,
+                    statistics=True)
+            plain = Similar(algorithms='efLmNs', negative=0)
+            for name in [u"Mercy General", u"Massachusetts General",
+                    u"American Board of Internal Medicine"]:
+                bloom.fill_arbor(name)
+                plain.fill_arbor(name)
+            roughs = [u"Mercy General", u"Merci General", u"Mercy Genral",
+                    u"Masachusetts General", u"Amer Board", u"Xylophonic",
+                    u"Qqq General", u"General Mercy"]
+            for rough in roughs:
+                self.assertEqual(bloom(rough), plain(rough))
+            encode = bloom.vocabulary.encode
+            self.assertTrue(bloom.rejects(encode([u'XYLOPHONIC'])))
+            self.assertFalse(bloom.rejects(encode([u'MERCI'])))
+            self.assertTrue(bloom.stats()['answers']['rejected'] >= 2)
+            for token in bloom.root.children():
+                self.assertTrue(token in bloom.bloom)
+            bloom.fill_arbor(u"Zzyzx Board")
+            self.assertTrue(bloom.bloom is None)
+            self.assertTrue(bloom(u"Zzyzx Board")[0])
+
+        def test_031_updates(self):
+            def state(similar):
+                # Everything an update must keep consistent, by words.
+                words = similar.vocabulary.tokens
+                def indexes(branch):
+                    tables = dict([(table, dict([(key, sorted(
+                        [words[token] for token in tokens]))
+                        for key, tokens in getattr(branch, table).items()]))
+                        for table in ('deletes', 'soundex', 'lengths')])
+                    tables['children'] = dict([(words[token],
+                        indexes(branch[token]))
+                        for token in branch.children()])
+                    return tables
+                return (similar.expand(), indexes(similar.root),
+                        dict([(words[letters], names) for letters, names
+                            in similar.acro.items()]),
+                        dict(similar.aliases.items()), similar.boards,
+                        similar.alias_keys(), dict(similar.joins.items()))
+
+            directory = tempfile.mkdtemp()
+            path = os.path.join(directory, 'boards.csv')
+            before = [
+                    '"Massachusetts Institute of Technology" "MIT"',
+                    '"Massachusetts General Hospital" "MGH"',
+                    '"Mercy General"',
+                    '"Mercy" "The Mercy"']
+            after = [
+                    '"Massachusetts Institute of Technology" "MIT" "M.I.T."',
+                    '"Mercy General"',
+                    '"Mercy Hospital"',
+                    '"Boston Medical Center" "BMC"']
+            with open(path, 'w') as target:
+                print>>target, string.join(before, '\n')
+            similar = Similar(cache=10)
+            for item in read_boards(path):
+                similar.fill_board(item)
+            self.assertEqual(similar(u"Massachusetts Genral Hospital")[1],
+                    'Massachusetts General Hospital')
+            self.assertFalse(similar(u"Boston Medical Centre")[0])
+
+            with open(path, 'w') as target:
+                print>>target, string.join(after, '\n')
+            self.assertEqual(similar.update_from_csv(path), (2, 2, 1))
+            self.assertEqual(similar.update_from_csv(path), (0, 0, 0))
+            fresh = Similar()
+            for item in read_boards(path):
+                fresh.fill_board(item)
+            self.assertEqual(state(similar), state(fresh))
+            # The caches forgot the old answers.
+            self.assertFalse(similar(u"Massachusetts Genral Hospital")[0])
+            self.assertEqual(similar(u"Boston Medical Centre")[1],
+                    'Boston Medical Center')
+            self.assertEqual(similar(u"MIT")[1],
+                    'Massachusetts Institute of Technology')
+            self.assertFalse(similar.remove_canonical(u"Nothing like it"))
+
+            # Byte str and unicode names lexing the same are told apart.
+            for name in ["H\xc3\xb4pital Central", u"H\xf4pital Central!",
+                    u"H\xf4pital  Central"]:
+                similar.fill_arbor(name)
+            warnings.simplefilter('error', UnicodeWarning)
+            try:
+                self.assertTrue(similar.remove_canonical(
+                    "H\xc3\xb4pital Central!"))
+                self.assertTrue(similar.remove_canonical(
+                    u"H\xf4pital Central"))
+                self.assertEqual(similar(u"Hopital Central")[1],
+                        u"H\xf4pital  Central")
+                self.assertTrue(similar.remove_canonical(
+                    u"H\xf4pital  Central"))
+            finally:
+                warnings.resetwarnings()
+            self.assertFalse(similar(u"Hopital Central")[0])
+
+            # Join entries go with the last name making them,
+            # in a loaded dictionary too.
+            names = [u"Mercy General Hospital", u"Mercy General",
+                    u"Boston General Hospital"]
+            joined = Similar(joins=2)
+            for name in names:
+                joined.fill_arbor(name)
+            joined.save_index(path + '.joins')
+            reloaded = Similar(joins=2).load_index(path + '.joins')
+            for each in (joined, reloaded):
+                for n in range(len(names)):
+                    rebuilt = Similar(joins=2)
+                    for name in names[n + 1:]:
+                        rebuilt.fill_arbor(name)
+                    self.assertTrue(each.remove_canonical(names[n]))
+                    self.assertEqual(dict(each.joins.items()), rebuilt.joins)
+                    self.assertEqual(each.join_counts(), rebuilt.join_counts())
+                self.assertEqual(each.joins, {})
+
+            # A dropped variant lexing as a kept one keeps their alias.
+            shared = os.path.join(directory, 'shared.csv')
+            mit = 'Massachusetts Institute of Technology'
+            updated = Similar()
+            for variants in [['Mass Inst Tech', 'Mass. Inst. Tech.'],
+                    ['Mass Inst Tech'], []]:
+                with open(shared, 'w') as target:
+                    print>>target, string.join(['"%s"' % name
+                        for name in [mit] + variants], ' ')
+                updated.update_from_csv(shared)
+                self.assertEqual(updated(u"Mass Inst Tech") == (True, mit,
+                    '='), bool(variants))
+            self.assertFalse(u'MASS INST TECH' in updated.aliases)
+
+            # A name lexing the same takes over the branch of a removed one.
+            similar.fill_arbor(u"The Mercy Hospital")
+            self.assertEqual(similar(u"Mercy Hospital")[1], u"Mercy Hospital")
+            self.assertTrue(similar.remove_canonical(u"Mercy Hospital"))
+            self.assertEqual(similar(u"Mercy Hospitl")[1],
+                    u"The Mercy Hospital")
+
+            # Frozen and loaded dictionaries are thawed to be changed.
+            similar.freeze()
+            self.assertTrue(similar.remove_canonical(u"The Mercy Hospital"))
+            self.assertTrue(isinstance(similar.root, Branch))
+            smaller = Similar()
+            for item in read_boards(path):
+                if item[0] != 'Mercy Hospital':
+                    smaller.fill_board(item)
+            self.assertEqual(state(similar), state(smaller))
+            fresh.save_index(path + '.idx')
+            loaded = Similar().load_index(path + '.idx')
+            self.assertEqual(loaded.update_from_csv(path), (0, 0, 0))
+            self.assertTrue(isinstance(loaded.root, FrozenBranch))
+            loaded.add_canonical(u"Mercy General Hospital", [u"MGH"])
+            self.assertEqual(loaded(u"MGH")[1], u"Mercy General Hospital")
+            self.assertEqual(loaded(u"Boston Medical Centre")[1],
+                    'Boston Medical Center')
+
+            # A server applies changes to its boards file between batches.
+            batcher = Batcher(fresh, boards=path, interval=0)
+            with open(path, 'a') as target:
+                print>>target, '"Tufts Medical Center"'
+            def fail(path):
+                raise IOError('unreadable')
+            stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+            try:
+                # A failed update is tried again at the next check.
+                fresh.update_from_csv = fail
+                batcher.refresh()
+                self.assertTrue('failed' in sys.stderr.getvalue())
+                self.assertFalse(fresh(u"Tufts Medical Centre")[0])
+                del fresh.update_from_csv
+                batcher.refresh()
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(fresh(u"Tufts Medical Centre")[1],
+                    'Tufts Medical Center')
+            self.assertEqual(batcher.stamp, batcher.modified())
+            shutil.rmtree(directory)
+
+        def test_032_keyboard(self):
+            # Layouts are compiled once and shared by every instance.
+            first, second = Similar(), Similar(keyboard='QWERTY')
+            self.assertTrue(first.fingers is second.fingers)
+            self.assertTrue(first.fast_lookup is second.fast_lookup)
+            self.assertFalse(first.fingers is Similar(
+                keyboard='DVORAK').fingers)
+            for name, layout in Similar.keyboard.iteritems():
+                fingers = Keyboard.compile([name], [layout])
+                self.assertEqual(sum(fingers.table), len([pair
+                    for pair in fingers.pairs if max(map(ord, pair)) < 256]))
+                for intended, keys in layout.iteritems():
+                    self.assertEqual(fingers.neighbors[intended],
+                            frozenset(keys))
+                    for key in keys:
+                        if max(ord(key), ord(intended)) > 255:
+                            continue
+                        self.assertTrue(fingers.table[
+                            first.generate_fat_finger_index(key, intended)])
+            fingers = first.fingers
+            self.assertTrue(fingers.near(u'FAT', u'GST'))
+            self.assertFalse(fingers.near(u'FAT', u'GSP'))
+            self.assertFalse(fingers.near(u"O'NEIL", u"O'NEIL"))
+            self.assertEqual(fingers.misses(u'FAT', u'GST'), 2)
+            self.assertEqual(fingers.misses(u"O'NEIL", u"O'NRIL"), 1)
+            self.assertEqual(fingers.misses(u'FAT', u'GSP'), None)
+            self.assertEqual(first.cost_fat_finger(u'FAT', u'GST'),
+                    Similar.costs['f'] ** 2)
+
+        def test_033_keyboards(self):
+            # Layouts are made from the rows of their keys.
+            rows = [(0.00, u'`1234567890-=', u'~!@#$%^&*()_+'),
+                    (1.50, u'qwertyuiop[]',  u'QWERTYUIOP{}'),
+                    (1.75, u"asdfghjkl;'",   u'ASDFGHJKL:"'),
+                    (2.25, u'zxcvbnm,./',    u'ZXCVBNM<>?')]
+            layout = Keyboard.layout(rows)
+            self.assertEqual(sorted(layout['D']), sorted(u'DdSERFCXserfcx'))
+            self.assertEqual(sorted(layout['Q']), sorted(u'Qq12WA!@wa'))
+            self.assertEqual(sorted(Similar.AZERTY['Q']),
+                    sorted(u'QqAaZzSsWw<>'))
+            self.assertEqual(sorted(Similar.QWERTZ['Y']),
+                    sorted(u'YyAaSsXx<>'))
+            # Several layouts are merged, a bit for each one,
+            # and a token is explained by one layout alone.
+            similar = Similar(keyboard='QWERTY,AZERTY')
+            self.assertEqual(similar.keyboards, ('QWERTY', 'AZERTY'))
+            fingers = similar.fingers
+            self.assertTrue(fingers is Similar(
+                keyboard=['QWERTY', 'AZERTY']).fingers)
+            self.assertEqual(fingers.explained(u'FAT', u'GST'), ['QWERTY'])
+            self.assertEqual(fingers.explained(u'ZOO', u'AOO'),
+                    ['QWERTY', 'AZERTY'])
+            self.assertEqual(fingers.explained(u'MAN', u'PAN'), ['AZERTY'])
+            self.assertEqual(fingers.explained(u'MAN', u'MAM'), ['QWERTY'])
+            self.assertEqual(fingers.explained(u'MAN', u'PAM'), [])
+            self.assertTrue(fingers.near(u'MAN', u'PAN'))
+            self.assertFalse(fingers.near(u'MAN', u'PAM'))
+            self.assertEqual(fingers.misses(u'MAN', u'PAM'), None)
+            self.assertEqual(fingers.misses(u'MAN', u'PQN'), 2)
+            self.assertEqual(fingers.table[
+                similar.generate_fat_finger_index(u'P', u'M')], 2)
+            self.assertTrue(similar.bool_algorithm_fat_finger(u'MAN', u'PAN'))
+            self.assertFalse(Similar().bool_algorithm_fat_finger(
+                u'MAN', u'PAN'))
+            self.assertRaises(ValueError, Keyboard, range(9), [{}] * 9)
+
+        def test_034_vocabulary(self):
+            vocabulary = Vocabulary(self.similar.generate_index_keys)
+            self.assertEqual(vocabulary.intern(u'MERCY'), 0)
+            self.assertEqual(vocabulary.intern(u'GENERAL'), 1)
+            self.assertEqual(vocabulary.intern(u'MERCY'), 0)
+            self.assertEqual(len(vocabulary), 2)
+            self.assertEqual(vocabulary.get(u'GENERAL'), 1)
+            self.assertEqual(vocabulary.get(u'NOWHERE'), None)
+            self.assertEqual(vocabulary.word(1), u'GENERAL')
+            self.assertEqual(vocabulary.word(u'NOWHERE'), u'NOWHERE')
+            # Unknown tokens are left as strings.
+            self.assertEqual(vocabulary.encode([u'MERCY', u'NOWHERE',
+                u'GENERAL']), [0, u'NOWHERE', 1])
+            self.assertEqual(vocabulary.features, [None, None])
+            self.assertEqual(vocabulary.keys(0)['lengths'], [5])
+            self.assertEqual(vocabulary.features[1], None)
+            ordered, remap = vocabulary.sorted()
+            self.assertEqual(ordered.tokens, [u'GENERAL', u'MERCY'])
+            self.assertEqual(remap, [1, 0])
+            self.assertEqual(ordered.features, [None, vocabulary.keys(0)])
+
+            # Arbor edges are token ids, in the order tokens were first seen,
+            # and freezing renumbers them in the order of their tokens.
+            names = [
+                    u"Mercy General Hospital",
+                    u"Massachusetts General Hospital",
+                    u"American Board of Internal Medicine"]
+            rough = [
+                    u"Mersy Genral Hospital",
+                    u"Mass Gen Hosp",
+                    u"ABIM",
+                    u"Nothing like it"]
+            similar = Similar()
+            for name in names:
+                similar.fill_arbor(name)
+            tokens = similar.vocabulary.tokens
+            self.assertEqual(tokens[:5], [u'MGH',
+                    u'MERCY', u'GENERAL', u'HOSPITAL', u'MASSACHUSETTS'])
+            self.assertEqual(sorted(similar.root.children()), [1, 4, 6])
+            expect = [similar(text) for text in rough]
+            ranked = [similar.rank(text) for text in rough]
+            similar.freeze()
+            tokens = similar.vocabulary.tokens
+            self.assertEqual(tokens, sorted(tokens))
+            self.assertEqual([similar.vocabulary.get(token)
+                for token in tokens], range(len(tokens)))
+            self.assertEqual([tokens[i] for i in similar.root.children()],
+                    [u'AMERICAN', u'MASSACHUSETTS', u'MERCY'])
+            self.assertEqual(sorted(similar.acro.keys()), [
+                similar.vocabulary.get(u'ABIM'),
+                similar.vocabulary.get(u'MGH')])
+            self.assertEqual([similar(text) for text in rough], expect)
+            self.assertEqual([similar.rank(text) for text in rough], ranked)
+
+
+    commands = {'canonicalize': canonicalize, 'serve': serve}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        sys.exit(commands[sys.argv[1]](sys.argv[2:]))
     unittest.main()